@@ -1,15 +1,26 @@
 import logging
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, ContextTypes, MessageHandler, filters, CallbackQueryHandler
-from urllib.parse import quote, unquote
+from urllib.parse import quote
 import psycopg2
 import psycopg2.extras
 from psycopg2 import pool
 import os
 from flask import Flask
 import random
+import socket
 import threading
 import time
+import asyncio
+import functools
+import bisect
+import heapq
+import math
+import copy
+import traceback
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 import re
 import unicodedata
@@ -25,11 +36,53 @@ TOKEN = os.getenv("BOT_TOKEN")
 DATABASE_URL = os.getenv("NEON_DATABASE_URL")
 
 POOL = None
+DB_EXECUTOR = None
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+# O pool fecha toda conexão devolvida além de minconn; abaixo do máximo, o excesso reabre TLS a cada checkout
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", str(DB_POOL_MAX)))
+# Depois do boot todo acesso ao banco passa pelo executor: um worker por conexão do pool.
+# Com menos workers sobram conexões para chamadas fora dele (o semáforo do pool faz esperar)
+DB_WORKERS = int(os.getenv("DB_WORKERS", str(DB_POOL_MAX)))
+# Quantos updates do Telegram são processados ao mesmo tempo
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "32"))
+# Só conexões ociosas há mais que isso (segundos) passam pelo SELECT 1 no checkout
+DB_VALIDATE_IDLE = float(os.getenv("DB_VALIDATE_IDLE", "30"))
+DB_CHECKOUT_TIMEOUT = float(os.getenv("DB_CHECKOUT_TIMEOUT", "15"))
+# Modo debug: guarda a pilha de cada checkout e avisa de conexões presas além do limite
+DB_DEBUG = os.getenv("DB_DEBUG", "").lower() in ("1", "true", "sim")
+DB_LEAK_THRESHOLD = float(os.getenv("DB_LEAK_THRESHOLD", "30"))
+PLAYER_CACHE_SIZE = int(os.getenv("PLAYER_CACHE_SIZE", "512"))
+PLAYER_CACHE_TTL = float(os.getenv("PLAYER_CACHE_TTL", "30"))
+USERNAME_CACHE_SIZE = int(os.getenv("USERNAME_CACHE_SIZE", "2048"))
+USERNAME_CACHE_TTL = float(os.getenv("USERNAME_CACHE_TTL", "600"))
+# last_seen é acumulado em memória e gravado em lote neste intervalo
+LAST_SEEN_FLUSH_INTERVAL = float(os.getenv("LAST_SEEN_FLUSH_INTERVAL", "60"))
+# Identifica este processo no lease das tarefas agendadas (várias réplicas do bot)
+INSTANCIA_ID = os.getenv("INSTANCIA_ID") or f"{socket.gethostname()}-{os.getpid()}"
+# Por quanto tempo uma réplica fica dona de uma execução antes de outra poder assumir
+AGENDA_LEASE = int(os.getenv("AGENDA_LEASE", "300"))
+# Intervalo para conferir se outro processo alterou os dados mantidos em memória
+CACHE_SYNC_INTERVAL = float(os.getenv("CACHE_SYNC_INTERVAL", "60"))
+# Grava as confirmações pendentes (/dar, /abandonar, /recarregar, /editarficha) no banco
+PENDENCIAS_PERSISTENTES = os.getenv("PENDENCIAS_PERSISTENTES", "1").lower() in ("1", "true", "sim")
+# Semanas de XP/turnos mantidas nas tabelas particionadas (0 = guarda tudo)
+HISTORICO_SEMANAS = int(os.getenv("HISTORICO_SEMANAS", "52"))
+# Partições mais antigas que isso são desanexadas e ficam como tabelas soltas; com "0" são apagadas
+HISTORICO_ARQUIVAR = os.getenv("HISTORICO_ARQUIVAR", "1").lower() in ("1", "true", "sim")
+# Limite de comandos (token bucket): "capacidade/fichas repostas por segundo"
+RATE_USUARIO = tuple(float(x) for x in os.getenv("RATE_USUARIO", "3/1").split("/"))
+# O Telegram aceita ~20 mensagens por minuto de um bot no mesmo grupo e ~30/s no total
+RATE_CHAT = tuple(float(x) for x in os.getenv("RATE_CHAT", "20/0.33").split("/"))
+RATE_GLOBAL = tuple(float(x) for x in os.getenv("RATE_GLOBAL", "30/30").split("/"))
+# Custo em fichas por comando ("ranking:2,itens:2"); os que não aparecem custam 1
+RATE_CUSTOS = {"ranking": 2, "itens": 2}
+RATE_CUSTOS.update({k.strip(): float(v) for k, v in (x.split(":") for x in os.getenv("RATE_CUSTOS", "").split(",") if ":" in x)})
+RATE_MAX_BALDES = int(os.getenv("RATE_MAX_BALDES", "4096"))
+# Guarda os baldes no Postgres para o limite valer somado entre réplicas
+RATE_COMPARTILHADO = os.getenv("RATE_COMPARTILHADO", "").lower() in ("1", "true", "sim")
 
 ADMIN_IDS = {int(x) for x in os.getenv("ADMINS", "").split(",") if x.strip().isdigit()}
 PESO_MAX = {1: 5.0, 2: 10.0, 3: 15.0, 4: 20.0, 5: 25.0, 6: 30.0}
-LAST_COMMAND = {}
-COOLDOWN = 1
 
 MAX_ATRIBUTOS = 20
 MAX_PERICIAS = 40
@@ -58,12 +111,7 @@ PERICIAS_LISTA = [
 ATRIBUTOS_NORMAL = {normalizar(a): a for a in ATRIBUTOS_LISTA}
 PERICIAS_NORMAL = {normalizar(p): p for p in PERICIAS_LISTA}
 
-EDIT_PENDING = {}
-EDIT_TIMERS = {}  # Para timeouts de edição
-
-TRANSFER_PENDING = {}
-ABANDON_PENDING = {}
-LAST_RELOAD = {}
+PENDENCIA_TTL = 300  # segundos para confirmar uma ação pendente
 
 KIT_BONUS = {
     "kit basico": 1,
@@ -96,25 +144,805 @@ TRAUMAS = [
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# ================== CACHE ==================
+class CacheLRU:
+    """Cache LRU com TTL, seguro entre threads, com contadores para dimensionamento."""
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._dados = OrderedDict()
+        self._lock = threading.Lock()
+        self._geracao = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def geracao(self):
+        """Marca a ser capturada antes de ler do banco; ver set()."""
+        return self._geracao
+
+    def get(self, chave):
+        with self._lock:
+            item = self._dados.get(chave)
+            if item is None:
+                self.misses += 1
+                return None
+            valor, expira = item
+            if expira < time.monotonic():
+                del self._dados[chave]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._dados.move_to_end(chave)
+            self.hits += 1
+            return valor
+
+    def set(self, chave, valor, geracao=None):
+        with self._lock:
+            # Uma invalidação aconteceu durante a leitura: o valor pode estar velho
+            if geracao is not None and geracao != self._geracao:
+                return
+            self._dados[chave] = (valor, time.monotonic() + self.ttl)
+            self._dados.move_to_end(chave)
+            while len(self._dados) > self.maxsize:
+                self._dados.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, chave):
+        with self._lock:
+            self._geracao += 1
+            self._dados.pop(chave, None)
+
+    def clear(self):
+        with self._lock:
+            self._geracao += 1
+            self._dados.clear()
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "tamanho": len(self._dados),
+                "max": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "hit_rate": (self.hits / total) if total else 0.0,
+            }
+
+PLAYER_CACHE = CacheLRU(PLAYER_CACHE_SIZE, PLAYER_CACHE_TTL)
+USERNAME_CACHE = CacheLRU(USERNAME_CACHE_SIZE, USERNAME_CACHE_TTL)
+# Último (username, first_name) gravado por uid; a TTL força uma regravação de vez em quando
+REGISTRO_CACHE = CacheLRU(USERNAME_CACHE_SIZE, 3600)
+
+CATALOGO_COLUNAS = ("nome", "peso", "consumivel", "bonus", "tipo", "arma_tipo", "arma_bonus",
+                    "muni_atual", "muni_max", "armas_compat", "rest_hunger", "rest_thirst")
+
+class CatalogoLocal:
+    """Cópia em memória da tabela catalogo, indexada pelo nome normalizado.
+
+    Toda alteração no catálogo incrementa a versão 'catalogo' em cache_versoes;
+    sincronizar() só relê a tabela quando essa versão muda.
+    """
+
+    def __init__(self):
+        self._itens = {}
+        self._versao = None
+        self._lock = threading.Lock()
+        self.recargas = 0
+
+    def carregar(self):
+        with conexao() as conn:
+            c = conn.cursor()
+            # Versão lida antes das linhas: no pior caso recarrega de novo na próxima sincronização
+            c.execute("SELECT versao FROM cache_versoes WHERE nome='catalogo'")
+            row = c.fetchone()
+            versao = row[0] if row else 0
+            c.execute(f"SELECT {', '.join(CATALOGO_COLUNAS)} FROM catalogo")
+            rows = c.fetchall()
+        itens = {normalizar(r[0]): dict(zip(CATALOGO_COLUNAS, r)) for r in rows}
+        with self._lock:
+            self._itens = itens
+            self._versao = versao
+            self.recargas += 1
+
+    def sincronizar(self):
+        with conexao() as conn:
+            c = conn.cursor()
+            c.execute("SELECT versao FROM cache_versoes WHERE nome='catalogo'")
+            row = c.fetchone()
+        if (row[0] if row else 0) != self._versao:
+            self.carregar()
+
+    def get(self, nome):
+        item = self._itens.get(normalizar(nome))
+        return dict(item) if item else None
+
+    def listar(self):
+        itens = sorted(self._itens.values(), key=lambda i: i["nome"])
+        return [tuple(i[col] for col in CATALOGO_COLUNAS[:10]) for i in itens]
+
+    def stats(self):
+        return {"itens": len(self._itens), "versao": self._versao, "recargas": self.recargas}
+
+CATALOGO = CatalogoLocal()
+
+class LiberadosLocal:
+    """Conjunto em memória dos usuários liberados, versionado como o catálogo."""
+
+    def __init__(self):
+        self._ids = frozenset()
+        self._versao = None
+        self._lock = threading.Lock()
+        self.recargas = 0
+
+    def carregar(self):
+        with conexao() as conn:
+            c = conn.cursor()
+            c.execute("SELECT versao FROM cache_versoes WHERE nome='liberados'")
+            row = c.fetchone()
+            versao = row[0] if row else 0
+            c.execute("SELECT user_id FROM liberados")
+            ids = frozenset(r[0] for r in c.fetchall())
+        with self._lock:
+            self._ids = ids
+            self._versao = versao
+            self.recargas += 1
+
+    def sincronizar(self):
+        with conexao() as conn:
+            c = conn.cursor()
+            c.execute("SELECT versao FROM cache_versoes WHERE nome='liberados'")
+            row = c.fetchone()
+        if (row[0] if row else 0) != self._versao:
+            self.carregar()
+
+    def contem(self, uid):
+        return uid in self._ids
+
+    def alterar(self, uid, liberado, versao):
+        """Aplica localmente uma alteração já commitada, sem reler a tabela."""
+        with self._lock:
+            self._ids = (self._ids | {uid}) if liberado else (self._ids - {uid})
+            # Só avança a versão se ninguém mais mexeu no meio; senão a sincronização relê
+            if self._versao is not None and versao == self._versao + 1:
+                self._versao = versao
+
+    def stats(self):
+        return {"ids": len(self._ids), "versao": self._versao, "recargas": self.recargas}
+
+LIBERADOS = LiberadosLocal()
+
+class PlacarSemanal:
+    """Ranking da semana em memória: lista ordenada de (-xp, pid) mantida com bisect.
+
+    Posição (RANK) e top N em O(log n) sem consultar o banco. Cada turno gravado
+    incrementa a versão 'placar' em cache_versoes; sincronizar() só relê a tabela
+    quando essa versão ou a semana muda.
+    """
+
+    def __init__(self):
+        self.semana = None
+        self._ordem = []
+        self._dados = {}  # pid -> (xp, streak, nome)
+        self._versao = None
+        self._lock = threading.Lock()
+        self.recargas = 0
+
+    def atual(self, semana):
+        return self.semana == semana
+
+    def carregar(self, semana):
+        with conexao() as conn:
+            c = conn.cursor()
+            # Versão lida antes das linhas: no pior caso recarrega de novo na próxima sincronização
+            c.execute("SELECT versao FROM cache_versoes WHERE nome='placar'")
+            row = c.fetchone()
+            versao = row[0] if row else 0
+            c.execute(
+                "SELECT x.player_id, x.xp_total, x.streak_atual, p.nome "
+                "FROM xp_semana x LEFT JOIN players p ON p.id = x.player_id "
+                "WHERE x.semana_inicio = %s",
+                (semana,)
+            )
+            rows = c.fetchall()
+        dados = {pid: (xp or 0, streak or 0, nome) for pid, xp, streak, nome in rows}
+        with self._lock:
+            # Um turno commitado durante a leitura já foi aplicado e avançou a versão:
+            # a leitura é mais velha que a memória e não pode sobrescrevê-la
+            if semana == self.semana and self._versao is not None and versao <= self._versao:
+                return
+            self._dados = dados
+            self._ordem = sorted((-xp, pid) for pid, (xp, _, _) in dados.items())
+            self.semana = semana
+            self._versao = versao
+            self.recargas += 1
+
+    def sincronizar(self, semana):
+        with conexao() as conn:
+            c = conn.cursor()
+            c.execute("SELECT versao FROM cache_versoes WHERE nome='placar'")
+            row = c.fetchone()
+        if semana != self.semana or (row[0] if row else 0) != self._versao:
+            self.carregar(semana)
+
+    def invalidar(self):
+        with self._lock:
+            self.semana = None
+            self._versao = None
+
+    def atualizar(self, semana, pid, xp, streak=None, nome=None, versao=None):
+        """Aplica o XP total já gravado de um jogador."""
+        with self._lock:
+            if semana != self.semana:
+                return
+            # Só avança a versão se ninguém mais mexeu no meio; senão a sincronização relê
+            if versao is not None and self._versao is not None and versao == self._versao + 1:
+                self._versao = versao
+            antigo = self._dados.get(pid)
+            if antigo:
+                i = bisect.bisect_left(self._ordem, (-antigo[0], pid))
+                if i < len(self._ordem) and self._ordem[i] == (-antigo[0], pid):
+                    del self._ordem[i]
+                streak = antigo[1] if streak is None else streak
+                nome = nome or antigo[2]
+            bisect.insort(self._ordem, (-xp, pid))
+            self._dados[pid] = (xp, streak or 0, nome)
+
+    def _linha(self, pid):
+        xp, streak, nome = self._dados[pid]
+        # RANK(): 1 + quantos têm XP estritamente maior
+        pos = bisect.bisect_left(self._ordem, (-xp,)) + 1
+        return pid, nome or f"ID:{pid}", xp, streak, pos
+
+    def consultar(self, uid, limite=10):
+        """Retorna (top, voce) no mesmo formato de get_ranking."""
+        with self._lock:
+            top = [self._linha(pid) for _, pid in self._ordem[:limite]]
+            voce = None
+            if uid in self._dados and uid not in {linha[0] for linha in top}:
+                voce = self._linha(uid)
+        return top, voce
+
+    def stats(self):
+        return {"jogadores": len(self._dados), "semana": self.semana, "versao": self._versao, "recargas": self.recargas}
+
+PLACAR = PlacarSemanal()
+
+class Pendencias:
+    """Ações esperando confirmação, por namespace e chave, cada uma com validade própria.
+
+    Em memória: dict + heap de expiração; as vencidas saem pelo topo do heap em
+    O(log n), sempre no event loop. Com persistência, cada escrita também vai para
+    a tabela pendencias: get() busca lá o que não está em memória e retirar() só
+    devolve a entrada para quem conseguir o DELETE, então a confirmação sobrevive
+    a reinícios e não é processada duas vezes por réplicas diferentes.
+    """
+
+    def __init__(self, persistente=False):
+        self.persistente = persistente
+        self._dados = {}  # (namespace, chave) -> (expira, valor)
+        self._heap = []   # (expira, namespace, chave); sobrescritas/removidas ficam até sair pelo topo
+        self.expiradas = 0
+
+    def _guardar_local(self, ns, chave, valor, expira):
+        self._dados[(ns, chave)] = (expira, valor)
+        heapq.heappush(self._heap, (expira, ns, chave))
+        if len(self._heap) > 2 * len(self._dados) + 64:
+            # Muitas entradas mortas no heap: reconstrói só com as vivas
+            self._heap = [(e, n, k) for (n, k), (e, _) in self._dados.items()]
+            heapq.heapify(self._heap)
+
+    def _db_gravar(self, ns, chave, valor, expira):
+        with conexao() as conn:
+            c = conn.cursor()
+            c.execute(
+                "INSERT INTO pendencias (namespace, chave, valor, expira) VALUES (%s, %s, %s, %s) "
+                "ON CONFLICT (namespace, chave) DO UPDATE SET valor = EXCLUDED.valor, expira = EXCLUDED.expira",
+                (ns, chave, psycopg2.extras.Json(valor), expira)
+            )
+            conn.commit()
+
+    def _db_ler(self, ns, chave, agora):
+        with conexao() as conn:
+            c = conn.cursor()
+            c.execute("SELECT expira, valor FROM pendencias WHERE namespace=%s AND chave=%s AND expira > %s", (ns, chave, agora))
+            return c.fetchone()
+
+    def _db_remover(self, ns, chave):
+        with conexao() as conn:
+            c = conn.cursor()
+            c.execute("DELETE FROM pendencias WHERE namespace=%s AND chave=%s RETURNING expira, valor", (ns, chave))
+            row = c.fetchone()
+            conn.commit()
+            return row
+
+    def carregar(self):
+        """Traz para a memória as pendências ainda válidas (no boot)."""
+        if not self.persistente:
+            return
+        with conexao() as conn:
+            c = conn.cursor()
+            c.execute("SELECT namespace, chave, expira, valor FROM pendencias WHERE expira > %s", (time.time(),))
+            rows = c.fetchall()
+        for ns, chave, expira, valor in rows:
+            self._guardar_local(ns, chave, valor, expira)
+
+    async def guardar(self, ns, chave, valor, ttl=PENDENCIA_TTL):
+        """Guarda (ou substitui) a pendência; valor precisa ser serializável em JSON."""
+        chave = str(chave)
+        expira = time.time() + ttl
+        if self.persistente:
+            await run_db(self._db_gravar, ns, chave, valor, expira)
+        self._guardar_local(ns, chave, valor, expira)
+
+    def ativas(self, ns):
+        """[(chave, expira)] das pendências válidas de um namespace, em memória."""
+        agora = time.time()
+        return [(k, e) for (n, k), (e, _) in self._dados.items() if n == ns and e > agora]
+
+    def contem(self, ns, chave):
+        """Só memória: para checagens a cada mensagem, sem ir ao banco.
+
+        As persistidas entram na memória no boot (carregar), antes do polling começar.
+        """
+        entrada = self._dados.get((ns, str(chave)))
+        return entrada is not None and entrada[0] > time.time()
+
+    async def get(self, ns, chave):
+        chave = str(chave)
+        agora = time.time()
+        entrada = self._dados.get((ns, chave))
+        if entrada and entrada[0] > agora:
+            return entrada[1]
+        if self.persistente:
+            row = await run_db(self._db_ler, ns, chave, agora)
+            if row:
+                self._guardar_local(ns, chave, row[1], row[0])
+                return row[1]
+        return None
+
+    async def retirar(self, ns, chave):
+        """Remove e retorna a pendência; None se venceu ou se outro processo já a retirou."""
+        chave = str(chave)
+        agora = time.time()
+        entrada = self._dados.pop((ns, chave), None)
+        if self.persistente:
+            entrada = await run_db(self._db_remover, ns, chave)
+        if not entrada or entrada[0] <= agora:
+            return None
+        return entrada[1]
+
+    def purgar(self, agora=None):
+        """Tira da memória as pendências vencidas. Roda no event loop."""
+        agora = agora if agora is not None else time.time()
+        removidas = 0
+        while self._heap and self._heap[0][0] <= agora:
+            expira, ns, chave = heapq.heappop(self._heap)
+            entrada = self._dados.get((ns, chave))
+            if entrada and entrada[0] == expira:
+                del self._dados[(ns, chave)]
+                removidas += 1
+        self.expiradas += removidas
+        return removidas
+
+    def purgar_banco(self):
+        with conexao() as conn:
+            c = conn.cursor()
+            c.execute("DELETE FROM pendencias WHERE expira <= %s", (time.time(),))
+            conn.commit()
+
+    def stats(self):
+        por_tipo = {}
+        for ns, _ in self._dados:
+            por_tipo[ns] = por_tipo.get(ns, 0) + 1
+        return {"ativas": len(self._dados), "heap": len(self._heap), "expiradas": self.expiradas,
+                "por_tipo": por_tipo, "persistente": self.persistente}
+
+PENDENCIAS = Pendencias(PENDENCIAS_PERSISTENTES)
+
+# Repõe e desconta as fichas de vários baldes de uma vez. Só volta a linha dos
+# baldes que tinham fichas suficientes; se faltar algum, a transação é desfeita.
+LIMITE_SQL = """
+    INSERT INTO limites_taxa AS l (chave, fichas, atualizado, capacidade, taxa)
+    SELECT v.chave, v.capacidade - %(custo)s, %(agora)s, v.capacidade, v.taxa
+    FROM unnest(%(chaves)s::text[], %(capacidades)s::float8[], %(taxas)s::float8[]) AS v(chave, capacidade, taxa)
+    ON CONFLICT (chave) DO UPDATE SET
+        fichas = LEAST(EXCLUDED.capacidade, l.fichas + GREATEST(EXCLUDED.atualizado - l.atualizado, 0) * EXCLUDED.taxa) - %(custo)s,
+        atualizado = GREATEST(l.atualizado, EXCLUDED.atualizado),
+        capacidade = EXCLUDED.capacidade,
+        taxa = EXCLUDED.taxa
+    WHERE LEAST(EXCLUDED.capacidade, l.fichas + GREATEST(EXCLUDED.atualizado - l.atualizado, 0) * EXCLUDED.taxa) >= %(custo)s
+    RETURNING l.chave
+"""
+
+class LimitadorTaxa:
+    """Token bucket por usuário, por chat e global, com custo por comando.
+
+    O comando passa só se os três baldes tiverem fichas, e aí sai dos três. Os
+    baldes ficam num OrderedDict limitado (LRU); um balde despejado volta cheio,
+    o mesmo estado de quem ficou parado. No modo compartilhado os baldes ficam
+    na tabela limites_taxa e valem para todas as réplicas.
+    """
+
+    def __init__(self, limites, custos, max_baldes=4096, compartilhado=False):
+        self.limites = limites  # escopo -> (capacidade, fichas por segundo)
+        self.custos = custos
+        self.max_baldes = max_baldes
+        self.compartilhado = compartilhado
+        self._baldes = OrderedDict()  # (escopo, id) -> (fichas, instante)
+        self.aceitos = 0
+        self.recusas = {}  # comando -> {escopo: n}
+        self.despejos = 0
+        self.falhas_banco = 0
+
+    def _custo(self, comando):
+        # Nunca acima da menor capacidade, senão o comando nunca passaria
+        return min(self.custos.get(comando, 1), min(cap for cap, _ in self.limites.values()))
+
+    def _chaves(self, uid, chat_id):
+        return [("usuario", uid), ("chat", chat_id if chat_id is not None else uid), ("global", 0)]
+
+    def _consumir_local(self, chaves, custo, agora):
+        """Retorna o escopo que recusou, ou None se as fichas foram descontadas."""
+        saldos = []
+        for chave in chaves:
+            capacidade, taxa = self.limites[chave[0]]
+            balde = self._baldes.get(chave)
+            fichas = capacidade if balde is None else min(capacidade, balde[0] + (agora - balde[1]) * taxa)
+            if fichas < custo:
+                return chave[0]
+            saldos.append((chave, fichas))
+        for chave, fichas in saldos:
+            self._baldes[chave] = (fichas - custo, agora)
+            self._baldes.move_to_end(chave)
+        while len(self._baldes) > self.max_baldes:
+            self._baldes.popitem(last=False)
+            self.despejos += 1
+        return None
+
+    def _consumir_banco(self, chaves, custo, agora):
+        nomes = [f"{escopo}:{ident}" for escopo, ident in chaves]
+        with conexao() as conn:
+            c = conn.cursor()
+            c.execute(LIMITE_SQL, {
+                "chaves": nomes,
+                "capacidades": [self.limites[escopo][0] for escopo, _ in chaves],
+                "taxas": [self.limites[escopo][1] for escopo, _ in chaves],
+                "custo": custo,
+                "agora": agora,
+            })
+            passaram = {row[0] for row in c.fetchall()}
+            for nome, (escopo, _) in zip(nomes, chaves):
+                if nome not in passaram:
+                    return escopo  # sem commit: conexao() desfaz o desconto dos outros baldes
+            conn.commit()
+        return None
+
+    async def permitir(self, comando, uid, chat_id):
+        custo = self._custo(comando)
+        chaves = self._chaves(uid, chat_id)
+        if self.compartilhado:
+            try:
+                recusa = await run_db(self._consumir_banco, chaves, custo, time.time())
+            except Exception as e:
+                self.falhas_banco += 1
+                logger.error(f"Limite compartilhado indisponível, usando o local: {e}")
+                recusa = self._consumir_local(chaves, custo, time.monotonic())
+        else:
+            recusa = self._consumir_local(chaves, custo, time.monotonic())
+        if recusa:
+            por_escopo = self.recusas.setdefault(comando, {})
+            por_escopo[recusa] = por_escopo.get(recusa, 0) + 1
+            return False
+        self.aceitos += 1
+        return True
+
+    def limpar_banco(self, parado=3600):
+        """Apaga baldes compartilhados parados há muito tempo (já estariam cheios)."""
+        with conexao() as conn:
+            c = conn.cursor()
+            c.execute("DELETE FROM limites_taxa WHERE atualizado < %s", (time.time() - parado,))
+            conn.commit()
+
+    def stats(self):
+        return {"baldes": len(self._baldes), "max": self.max_baldes, "aceitos": self.aceitos,
+                "recusas": {cmd: dict(n) for cmd, n in self.recusas.items()}, "despejos": self.despejos,
+                "compartilhado": self.compartilhado, "falhas_banco": self.falhas_banco}
+
+LIMITES = LimitadorTaxa(
+    {"usuario": RATE_USUARIO, "chat": RATE_CHAT, "global": RATE_GLOBAL},
+    RATE_CUSTOS, RATE_MAX_BALDES, RATE_COMPARTILHADO
+)
+
+def incrementar_versao(c, nome):
+    """Marca o cache 'nome' como alterado, dentro da transação do cursor c."""
+    c.execute(
+        "INSERT INTO cache_versoes (nome, versao) VALUES (%s, 1) "
+        "ON CONFLICT (nome) DO UPDATE SET versao = cache_versoes.versao + 1 RETURNING versao",
+        (nome,)
+    )
+    return c.fetchone()[0]
+
 # ================== POSTGRESQL ==================
+# ThreadedConnectionPool levanta PoolError quando esgota; o semáforo faz o checkout esperar
+_POOL_SLOTS = threading.BoundedSemaphore(DB_POOL_MAX)
+_POOL_LOCK = threading.Lock()
+_CONN_DEVOLVIDA_EM = {}
+_CONN_SUSPEITAS = set()
+_CHECKOUTS = {}
+POOL_STATS = {
+    "checkouts": 0,
+    "espera_total": 0.0,
+    "espera_max": 0.0,
+    "em_uso": 0,
+    "pico_em_uso": 0,
+    "validacoes": 0,
+    "reconexoes": 0,
+    "aberturas": 0,
+    "esgotamentos": 0,
+}
+
+def _precisa_validar(conn):
+    chave = id(conn)
+    with _POOL_LOCK:
+        if chave in _CONN_SUSPEITAS:
+            return True
+        devolvida = _CONN_DEVOLVIDA_EM.get(chave)
+    # Conexão recém-aberta pelo pool não tem registro e não precisa de teste
+    return devolvida is not None and time.monotonic() - devolvida > DB_VALIDATE_IDLE
+
+def _esquecer_conn(conn):
+    with _POOL_LOCK:
+        _CONN_DEVOLVIDA_EM.pop(id(conn), None)
+        _CONN_SUSPEITAS.discard(id(conn))
+
+def _verificar_vazamentos(todas=False):
+    """Avisa (uma vez por checkout) das conexões emprestadas há mais de DB_LEAK_THRESHOLD."""
+    agora = time.monotonic()
+    with _POOL_LOCK:
+        presas = [info for info in _CHECKOUTS.values()
+                  if todas or (not info["avisado"] and agora - info["desde"] > DB_LEAK_THRESHOLD)]
+        for info in presas:
+            info["avisado"] = True
+    for info in presas:
+        logger.warning(
+            f"Conexão emprestada há {agora - info['desde']:.1f}s pela thread {info['thread']} e ainda não devolvida. "
+            f"Checkout feito em:\n{''.join(info['pilha'])}"
+        )
+
 def get_conn():
-    conn = POOL.getconn()
+    inicio = time.monotonic()
+    if DB_DEBUG:
+        _verificar_vazamentos()
+    if not _POOL_SLOTS.acquire(blocking=False):
+        with _POOL_LOCK:
+            POOL_STATS["esgotamentos"] += 1
+        logger.warning("Pool de conexões esgotado, aguardando uma conexão livre")
+        if DB_DEBUG:
+            _verificar_vazamentos(todas=True)
+        if not _POOL_SLOTS.acquire(timeout=DB_CHECKOUT_TIMEOUT):
+            raise pool.PoolError("connection pool exhausted")
     try:
-        with conn.cursor() as c:
-            c.execute("SELECT 1")
-    except psycopg2.Error:
-        POOL.putconn(conn, close=True)
         conn = POOL.getconn()
+        with _POOL_LOCK:
+            # Sem registro de devolução: o pool acabou de abrir esta conexão
+            if id(conn) not in _CONN_DEVOLVIDA_EM:
+                POOL_STATS["aberturas"] += 1
+        if conn.closed or _precisa_validar(conn):
+            with _POOL_LOCK:
+                POOL_STATS["validacoes"] += 1
+            try:
+                with conn.cursor() as c:
+                    c.execute("SELECT 1")
+            except psycopg2.Error:
+                _esquecer_conn(conn)
+                POOL.putconn(conn, close=True)
+                conn = POOL.getconn()
+                with _POOL_LOCK:
+                    POOL_STATS["reconexoes"] += 1
+    except Exception:
+        _POOL_SLOTS.release()
+        raise
+    _esquecer_conn(conn)
+    espera = time.monotonic() - inicio
+    with _POOL_LOCK:
+        POOL_STATS["checkouts"] += 1
+        POOL_STATS["espera_total"] += espera
+        POOL_STATS["espera_max"] = max(POOL_STATS["espera_max"], espera)
+        POOL_STATS["em_uso"] += 1
+        POOL_STATS["pico_em_uso"] = max(POOL_STATS["pico_em_uso"], POOL_STATS["em_uso"])
+        if DB_DEBUG:
+            _CHECKOUTS[id(conn)] = {
+                "desde": time.monotonic(),
+                "thread": threading.current_thread().name,
+                "pilha": traceback.format_stack(limit=12)[:-1],
+                "avisado": False,
+            }
     return conn
 
-def put_conn(conn):
+def put_conn(conn, falhou=False):
     """Devolve uma conexão para o pool."""
-    POOL.putconn(conn)
+    try:
+        # Query que falhou (ou conexão caída): valida no próximo checkout
+        suspeita = falhou or conn.closed or conn.info.transaction_status in (
+            psycopg2.extensions.TRANSACTION_STATUS_INERROR,
+            psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN,
+        )
+        with _POOL_LOCK:
+            checkout = _CHECKOUTS.pop(id(conn), None)
+            POOL_STATS["em_uso"] -= 1
+        if checkout and not checkout["avisado"]:
+            segurada = time.monotonic() - checkout["desde"]
+            if segurada > DB_LEAK_THRESHOLD:
+                logger.warning(
+                    f"Conexão segurada por {segurada:.1f}s (limite {DB_LEAK_THRESHOLD:.0f}s). "
+                    f"Checkout feito em:\n{''.join(checkout['pilha'])}"
+                )
+        # Registrado só depois do putconn: se o pool fechou a conexão, o id dela pode ser
+        # reaproveitado por uma nova, que não pode herdar o horário nem a suspeita. O lock
+        # cobre o putconn para ninguém pegar a conexão antes do registro
+        with _POOL_LOCK:
+            POOL.putconn(conn)
+            if conn.closed:
+                _CONN_DEVOLVIDA_EM.pop(id(conn), None)
+                _CONN_SUSPEITAS.discard(id(conn))
+            else:
+                _CONN_DEVOLVIDA_EM[id(conn)] = time.monotonic()
+                if suspeita:
+                    _CONN_SUSPEITAS.add(id(conn))
+    finally:
+        _POOL_SLOTS.release()
 
-def init_db():
-    conn = None
+@contextmanager
+def conexao():
+    """Empresta uma conexão do pool e garante a devolução, inclusive em return antecipado ou exceção.
+
+    O commit continua explícito; o que não foi commitado é desfeito ao sair do bloco.
+    """
+    conn = get_conn()
+    falhou = False
     try:
-        conn = get_conn()
+        yield conn
+    except psycopg2.Error:
+        falhou = True
+        raise
+    finally:
+        if not conn.closed:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                falhou = True
+        put_conn(conn, falhou)
+
+def pool_stats():
+    with _POOL_LOCK:
+        stats = dict(POOL_STATS)
+    stats["espera_media"] = stats["espera_total"] / stats["checkouts"] if stats["checkouts"] else 0.0
+    stats["max"] = DB_POOL_MAX
+    return stats
+
+async def run_db(func, *args, **kwargs):
+    """Executa um helper síncrono de banco no executor, sem travar o event loop."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(DB_EXECUTOR, functools.partial(func, *args, **kwargs))
+
+# ================== PARTIÇÕES SEMANAIS ==================
+# Histórico por semana: uma partição por segunda-feira (tabela_pAAAAMMDD).
+# Fechar a semana não apaga nada e o histórico antigo sai inteiro, partição por partição.
+TABELAS_SEMANAIS = {
+    "turnos": ("data", """
+        player_id BIGINT,
+        data DATE,
+        caracteres INTEGER,
+        mencoes TEXT,
+        PRIMARY KEY (player_id, data)
+    """),
+    "xp_semana": ("semana_inicio", """
+        player_id BIGINT,
+        semana_inicio DATE,
+        xp_total INTEGER DEFAULT 0,
+        streak_atual INTEGER DEFAULT 0,
+        ultimo_turno DATE,  -- data do último turno da semana, para a streak
+        PRIMARY KEY (player_id, semana_inicio)
+    """),
+    "interacoes_mutuas": ("semana_inicio", """
+        semana_inicio DATE,
+        jogador1 BIGINT,
+        jogador2 BIGINT,
+        PRIMARY KEY (semana_inicio, jogador1, jogador2)
+    """),
+    "turno_mencoes": ("data", """
+        data DATE,
+        de BIGINT,
+        para BIGINT,
+        PRIMARY KEY (data, de, para)
+    """),
+}
+
+def nome_particao(tabela, semana):
+    return f"{tabela}_p{semana:%Y%m%d}"
+
+def criar_particoes(c, semanas, tabelas=TABELAS_SEMANAIS):
+    for semana in sorted(set(semanas)):
+        for tabela in tabelas:
+            c.execute(
+                f"CREATE TABLE IF NOT EXISTS {nome_particao(tabela, semana)} PARTITION OF {tabela} "
+                "FOR VALUES FROM (%s) TO (%s)",
+                (semana, semana + timedelta(days=7))
+            )
+
+def listar_particoes(c):
+    """Retorna [(tabela, particao, semana)] das partições anexadas."""
+    c.execute(
+        "SELECT pai.relname, filha.relname FROM pg_inherits i "
+        "JOIN pg_class pai ON pai.oid = i.inhparent "
+        "JOIN pg_class filha ON filha.oid = i.inhrelid "
+        "WHERE pai.relname = ANY(%s)",
+        (list(TABELAS_SEMANAIS),)
+    )
+    particoes = []
+    for tabela, particao in c.fetchall():
+        try:
+            semana = datetime.strptime(particao.rsplit("_p", 1)[1], "%Y%m%d").date()
+        except (IndexError, ValueError):
+            continue
+        particoes.append((tabela, particao, semana))
+    return particoes
+
+def _tabela_semanal(c, tabela):
+    """Cria a tabela particionada; se já existir como tabela comum, migra os dados. Retorna as semanas migradas."""
+    chave, colunas = TABELAS_SEMANAIS[tabela]
+    c.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)", (tabela,))
+    row = c.fetchone()
+    if row and row[0] == "p":
+        return set()
+    legado = f"{tabela}_legado"
+    if row:
+        c.execute(f"ALTER TABLE {tabela} RENAME TO {legado}")
+        # Os índices (e a PK) mantêm o nome ao renomear a tabela; libera os nomes para a nova
+        c.execute("SELECT indexrelid::regclass::text FROM pg_index WHERE indrelid = to_regclass(%s)", (legado,))
+        for (indice,) in c.fetchall():
+            c.execute(f"ALTER INDEX {indice} RENAME TO {indice}_legado")
+    c.execute(f"CREATE TABLE {tabela} ({colunas}) PARTITION BY RANGE ({chave})")
+    if not row:
+        return set()
+    c.execute(f"SELECT DISTINCT {chave} - EXTRACT(ISODOW FROM {chave})::int + 1 FROM {legado} WHERE {chave} IS NOT NULL")
+    semanas = {r[0] for r in c.fetchall()}
+    criar_particoes(c, semanas, [tabela])
+    c.execute("SELECT column_name FROM information_schema.columns WHERE table_name = %s", (legado,))
+    lista = ", ".join(r[0] for r in c.fetchall())
+    c.execute(f"INSERT INTO {tabela} ({lista}) SELECT {lista} FROM {legado} WHERE {chave} IS NOT NULL")
+    c.execute(f"DROP TABLE {legado}")
+    logger.info(f"📦 {tabela} migrada para partições semanais ({len(semanas)} semanas)")
+    return semanas
+
+def manter_particoes():
+    """Cria as partições da semana atual e da próxima e tira do banco as que passaram do histórico."""
+    atual = semana_atual()
+    with conexao() as conn:
+        c = conn.cursor()
+        criar_particoes(c, [atual, atual + timedelta(days=7)])
+        removidas = 0
+        if HISTORICO_SEMANAS > 0:
+            limite = atual - timedelta(weeks=HISTORICO_SEMANAS)
+            for tabela, particao, semana in listar_particoes(c):
+                if semana >= limite:
+                    continue
+                if HISTORICO_ARQUIVAR:
+                    c.execute(f"ALTER TABLE {tabela} DETACH PARTITION {particao}")
+                else:
+                    c.execute(f"DROP TABLE {particao}")
+                removidas += 1
+        conn.commit()
+    if removidas:
+        logger.info(f"🗄️ {removidas} partições antigas {'arquivadas' if HISTORICO_ARQUIVAR else 'apagadas'}")
+
+def init_db():
+    with conexao() as conn:
         c = conn.cursor()
         c.execute('''CREATE TABLE IF NOT EXISTS players (
             id BIGINT PRIMARY KEY,
@@ -126,9 +954,9 @@ def init_db():
             rerolls INTEGER DEFAULT 3,
             hp_max INTEGER DEFAULT 0,
             sp_max INTEGER DEFAULT 0,
-            fome INTEGER DEFAULT 0,
-            sede INTEGER DEFAULT 0,
-            sono INTEGER DEFAULT 0,
+            fome INTEGER,
+            sede INTEGER,
+            sono INTEGER,
             traumas TEXT DEFAULT ''
         )''')
         c.execute('''CREATE TABLE IF NOT EXISTS usernames (
@@ -188,12 +1016,25 @@ def init_db():
         for alter in [
             "ADD COLUMN IF NOT EXISTS ultimo_alimento TIMESTAMP DEFAULT NOW()",
             "ADD COLUMN IF NOT EXISTS ultima_agua TIMESTAMP DEFAULT NOW()",
-            "ADD COLUMN IF NOT EXISTS ultimo_sono TIMESTAMP DEFAULT NOW()"
+            "ADD COLUMN IF NOT EXISTS ultimo_sono TIMESTAMP DEFAULT NOW()",
+            # Ajustes explícitos (ex.: /dormir aumenta fome) somados ao valor derivado do tempo
+            "ADD COLUMN IF NOT EXISTS ajuste_fome INTEGER DEFAULT 0",
+            "ADD COLUMN IF NOT EXISTS ajuste_sede INTEGER DEFAULT 0",
+            "ADD COLUMN IF NOT EXISTS ajuste_sono INTEGER DEFAULT 0",
+            # Nível absoluto antigo: só lido uma vez, por migrar_necessidades_legadas
+            "ADD COLUMN IF NOT EXISTS fome INTEGER",
+            "ADD COLUMN IF NOT EXISTS sede INTEGER",
+            "ADD COLUMN IF NOT EXISTS sono INTEGER",
+            # Dia de jogo a que 'rerolls' se refere; em outro dia o jogador tem REROLLS_DIARIOS
+            "ADD COLUMN IF NOT EXISTS rerolls_reset DATE"
         ]:
             try:
                 c.execute(f"ALTER TABLE players {alter};")
             except Exception:
                 conn.rollback()
+        migrar_necessidades_legadas(c)
+        # Saldos gravados antes do reset preguiçoso valem para o dia de jogo atual
+        c.execute("UPDATE players SET rerolls_reset=%s WHERE rerolls_reset IS NULL", (dia_de_jogo(),))
 
         for alter in [
             "ADD COLUMN IF NOT EXISTS consumivel BOOLEAN DEFAULT FALSE",
@@ -228,180 +1069,305 @@ def init_db():
             player_id BIGINT PRIMARY KEY,
             ultima_data DATE
         )''')
-        c.execute('''CREATE TABLE IF NOT EXISTS turnos (
-            player_id BIGINT,
-            data DATE,
-            caracteres INTEGER,
-            mencoes TEXT,
-            PRIMARY KEY (player_id, data)
+        # turnos, xp_semana, interacoes_mutuas e turno_mencoes (menções como arestas
+        # dia/quem mencionou/quem foi mencionado) são particionadas por semana
+        semanas = set()
+        for tabela in TABELAS_SEMANAIS:
+            semanas |= _tabela_semanal(c, tabela)
+        atual = semana_atual()
+        criar_particoes(c, semanas | {atual, atual + timedelta(days=7)})
+        c.execute("CREATE INDEX IF NOT EXISTS xp_semana_ranking_idx ON xp_semana (semana_inicio, xp_total DESC)")
+        c.execute("CREATE INDEX IF NOT EXISTS turno_mencoes_para_idx ON turno_mencoes (data, para)")
+        c.execute("SELECT EXISTS (SELECT 1 FROM turno_mencoes)")
+        if not c.fetchone()[0]:
+            # Migração única a partir do texto de turnos.mencoes
+            c.execute("""
+                INSERT INTO turno_mencoes (data, de, para)
+                SELECT t.data, t.player_id, u.user_id
+                FROM turnos t
+                CROSS JOIN LATERAL unnest(string_to_array(t.mencoes, ',')) AS m(username)
+                JOIN usernames u ON u.username = lower(m.username)
+                WHERE t.mencoes <> '' AND u.user_id <> t.player_id
+                ON CONFLICT DO NOTHING
+            """)
+        c.execute('''CREATE TABLE IF NOT EXISTS liberados (
+            user_id BIGINT PRIMARY KEY
         )''')
-        c.execute('''CREATE TABLE IF NOT EXISTS xp_semana (
-            player_id BIGINT,
-            semana_inicio DATE,
-            xp_total INTEGER DEFAULT 0,
-            streak_atual INTEGER DEFAULT 0,
-            PRIMARY KEY (player_id, semana_inicio)
+
+        # Nome normalizado (minúsculo e sem acento, igual a normalizar()) para busca por índice
+        c.execute("ALTER TABLE inventario ADD COLUMN IF NOT EXISTS nome_norm TEXT")
+        c.execute("ALTER TABLE catalogo ADD COLUMN IF NOT EXISTS nome_norm TEXT")
+        c.execute("SELECT player_id, nome FROM inventario WHERE nome_norm IS NULL")
+        pendentes = c.fetchall()
+        if pendentes:
+            c.execute(
+                "UPDATE inventario i SET nome_norm = v.norm "
+                "FROM unnest(%s::bigint[], %s::text[], %s::text[]) AS v(pid, nome, norm) "
+                "WHERE i.player_id = v.pid AND i.nome = v.nome",
+                ([r[0] for r in pendentes], [r[1] for r in pendentes], [normalizar(r[1]) for r in pendentes])
+            )
+        c.execute("SELECT nome FROM catalogo WHERE nome_norm IS NULL")
+        pendentes = c.fetchall()
+        if pendentes:
+            c.execute(
+                "UPDATE catalogo k SET nome_norm = v.norm "
+                "FROM unnest(%s::text[], %s::text[]) AS v(nome, norm) WHERE k.nome = v.nome",
+                ([r[0] for r in pendentes], [normalizar(r[0]) for r in pendentes])
+            )
+        c.execute("CREATE INDEX IF NOT EXISTS inventario_nome_norm_idx ON inventario (player_id, nome_norm)")
+        c.execute("CREATE INDEX IF NOT EXISTS catalogo_nome_norm_idx ON catalogo (nome_norm)")
+        c.execute("""
+            UPDATE xp_semana x SET ultimo_turno = (
+                SELECT MAX(t.data) FROM turnos t
+                WHERE t.player_id = x.player_id AND t.data >= x.semana_inicio AND t.data < x.semana_inicio + 7
+            )
+            WHERE x.ultimo_turno IS NULL
+        """)
+        c.execute('''CREATE TABLE IF NOT EXISTS agendamentos (
+            nome TEXT PRIMARY KEY,
+            ultima_execucao TIMESTAMP
         )''')
-        c.execute('''CREATE TABLE IF NOT EXISTS interacoes_mutuas (
-            semana_inicio DATE,
-            jogador1 BIGINT,
-            jogador2 BIGINT,
-            PRIMARY KEY (semana_inicio, jogador1, jogador2)
+        c.execute("ALTER TABLE agendamentos ADD COLUMN IF NOT EXISTS dono TEXT")
+        c.execute("ALTER TABLE agendamentos ADD COLUMN IF NOT EXISTS lease_ate TIMESTAMP")
+        c.execute('''CREATE TABLE IF NOT EXISTS pendencias (
+            namespace TEXT,
+            chave TEXT,
+            valor JSONB,
+            expira DOUBLE PRECISION,
+            PRIMARY KEY (namespace, chave)
         )''')
-        c.execute('''CREATE TABLE IF NOT EXISTS liberados (
-            user_id BIGINT PRIMARY KEY
+        c.execute("CREATE INDEX IF NOT EXISTS pendencias_expira_idx ON pendencias (expira)")
+        c.execute('''CREATE TABLE IF NOT EXISTS limites_taxa (
+            chave TEXT PRIMARY KEY,
+            fichas DOUBLE PRECISION,
+            atualizado DOUBLE PRECISION,
+            capacidade DOUBLE PRECISION,
+            taxa DOUBLE PRECISION
+        )''')
+        c.execute('''CREATE TABLE IF NOT EXISTS cache_versoes (
+            nome TEXT PRIMARY KEY,
+            versao BIGINT NOT NULL DEFAULT 0
         )''')
         conn.commit()
-    finally:
-        if conn:
-            put_conn(conn)
 
 def liberar_usuario(user_id: int):
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute("INSERT INTO liberados (user_id) VALUES (%s) ON CONFLICT DO NOTHING", (user_id,))
-    conn.commit()
-    put_conn(conn)
+    with conexao() as conn:
+        c = conn.cursor()
+        c.execute("INSERT INTO liberados (user_id) VALUES (%s) ON CONFLICT DO NOTHING", (user_id,))
+        versao = incrementar_versao(c, "liberados")
+        conn.commit()
+    LIBERADOS.alterar(user_id, True, versao)
 
 def desliberar_usuario(user_id: int):
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute("DELETE FROM liberados WHERE user_id=%s", (user_id,))
-    conn.commit()
-    put_conn(conn)
+    with conexao() as conn:
+        c = conn.cursor()
+        c.execute("DELETE FROM liberados WHERE user_id=%s", (user_id,))
+        versao = incrementar_versao(c, "liberados")
+        conn.commit()
+    LIBERADOS.alterar(user_id, False, versao)
 
 def is_liberado(uid: int) -> bool:
-    if is_admin(uid):
-        return True
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute("SELECT 1 FROM liberados WHERE user_id=%s", (uid,))
-    res = c.fetchone()
-    put_conn(conn)
-    return bool(res)
+    """Consulta só a memória; pode ser chamada direto no event loop."""
+    return is_admin(uid) or LIBERADOS.contem(uid)
 
 def acesso_negado(update):
-    return update.message.reply_text("🚫 Você precisa ser liberado por um administrador para usar o bot.")
+    # effective_message: também é chamado a partir de botões, onde update.message é None
+    return update.effective_message.reply_text("🚫 Você precisa ser liberado por um administrador para usar o bot.")
+
+_LAST_SEEN_PENDENTE = {}
+_LAST_SEEN_LOCK = threading.Lock()
 
 def register_username(user_id: int, username: str | None, first_name: str | None):
     if not username:
         return
     username = username.lower()
     now = int(time.time())
-    conn = None
-    try:
-        conn = get_conn()
+    with conexao() as conn:
         c = conn.cursor()
         c.execute("INSERT INTO usernames(username, user_id, first_name, last_seen) VALUES(%s,%s,%s,%s) ON CONFLICT (username) DO UPDATE SET user_id=%s, first_name=%s, last_seen=%s",
             (username, user_id, first_name or '', now, user_id, first_name or '', now))
         c.execute("UPDATE players SET username=%s WHERE id=%s", (username, user_id))
         conn.commit()
-    finally:
-        if conn:
-            put_conn(conn)
+        PLAYER_CACHE.invalidate(user_id)
+    USERNAME_CACHE.set(username, user_id)
+    REGISTRO_CACHE.set(user_id, (username, first_name or ''))
+
+async def registrar_usuario(user_id: int, username: str | None, first_name: str | None):
+    """register_username para os handlers: só vai ao banco se username ou nome mudaram.
+
+    O last_seen fica pendente em memória e é gravado em lote por flush_last_seen().
+    """
+    if not username:
+        return
+    username = username.lower()
+    with _LAST_SEEN_LOCK:
+        _LAST_SEEN_PENDENTE[username] = int(time.time())
+    if REGISTRO_CACHE.get(user_id) == (username, first_name or ''):
+        return
+    await run_db(register_username, user_id, username, first_name)
+
+def flush_last_seen():
+    """Grava numa só query os last_seen acumulados desde o último flush."""
+    with _LAST_SEEN_LOCK:
+        if not _LAST_SEEN_PENDENTE:
+            return
+        pendentes = dict(_LAST_SEEN_PENDENTE)
+        _LAST_SEEN_PENDENTE.clear()
+    try:
+        with conexao() as conn:
+            c = conn.cursor()
+            c.execute(
+                "UPDATE usernames u SET last_seen = v.ts "
+                "FROM unnest(%s::text[], %s::bigint[]) AS v(username, ts) "
+                "WHERE u.username = v.username AND (u.last_seen IS NULL OR u.last_seen < v.ts)",
+                (list(pendentes), list(pendentes.values()))
+            )
+            conn.commit()
+    except Exception:
+        # Devolve para a próxima tentativa sem sobrescrever o que chegou nesse meio-tempo
+        with _LAST_SEEN_LOCK:
+            for username, ts in pendentes.items():
+                if _LAST_SEEN_PENDENTE.get(username, 0) < ts:
+                    _LAST_SEEN_PENDENTE[username] = ts
+        raise
+
+def _chave_username(user_tag: str) -> str:
+    return user_tag[1:].lower() if user_tag.startswith('@') else user_tag.lower()
+
+def usernames_to_ids(user_tags) -> dict:
+    """Resolve vários @usernames de uma vez (memória primeiro, o resto numa só query).
+
+    Retorna {username_minusculo_sem_arroba: user_id} só com os encontrados.
+    """
+    chaves = {_chave_username(t) for t in user_tags if t}
+    ids = {}
+    faltando = []
+    for uname in chaves:
+        uid = USERNAME_CACHE.get(uname)
+        if uid is None:
+            faltando.append(uname)
+        else:
+            ids[uname] = uid
+    if faltando:
+        geracao = USERNAME_CACHE.geracao()
+        with conexao() as conn:
+            c = conn.cursor()
+            c.execute("SELECT username, user_id FROM usernames WHERE username = ANY(%s)", (faltando,))
+            rows = c.fetchall()
+        for uname, uid in rows:
+            USERNAME_CACHE.set(uname, uid, geracao)
+            ids[uname] = uid
+    return ids
 
 def username_to_id(user_tag: str) -> int | None:
     if not user_tag:
         return None
-    if user_tag.startswith('@'):
-        uname = user_tag[1:].lower()
-    else:
-        uname = user_tag.lower()
-    conn = None
-    try:
-        conn = get_conn()
-        c = conn.cursor()
-        c.execute("SELECT user_id FROM usernames WHERE username=%s", (uname,))
-        row = c.fetchone()
-        return row[0] if row else None
-    finally:
-        if conn:
-            put_conn(conn)
+    return usernames_to_ids([user_tag]).get(_chave_username(user_tag))
+
+PLAYER_SNAPSHOT_SQL = """
+    SELECT p.*,
+        COALESCE((SELECT json_object_agg(a.nome, a.valor) FROM atributos a WHERE a.player_id = p.id), '{}') AS atributos,
+        COALESCE((SELECT json_object_agg(pe.nome, pe.valor) FROM pericias pe WHERE pe.player_id = p.id), '{}') AS pericias,
+        COALESCE((SELECT json_agg(json_build_object(
+                      'nome', i.nome, 'peso', i.peso, 'quantidade', i.quantidade,
+                      'municao_atual', i.municao_atual, 'municao_max', i.municao_max))
+                  FROM inventario i WHERE i.player_id = p.id), '[]') AS inventario
+    FROM players p
+    WHERE p.id = ANY(%s)
+"""
+
+def _player_from_row(row):
+    player = {
+        "id": row["id"],
+        "nome": row["nome"],
+        "username": row["username"],
+        "peso_max": row["peso_max"],
+        "hp": row["hp"],
+        "hp_max": row["hp_max"],
+        "sp": row["sp"],
+        "sp_max": row["sp_max"],
+        "rerolls": row["rerolls"],
+        "rerolls_reset": row["rerolls_reset"],
+        "ultimo_alimento": row["ultimo_alimento"],
+        "ultima_agua": row["ultima_agua"],
+        "ultimo_sono": row["ultimo_sono"],
+        "ajuste_fome": row["ajuste_fome"] or 0,
+        "ajuste_sede": row["ajuste_sede"] or 0,
+        "ajuste_sono": row["ajuste_sono"] or 0,
+        "traumas": row.get("traumas", ""),
+        "atributos": dict(row["atributos"]),
+        "pericias": dict(row["pericias"]),
+        "inventario": []
+    }
+    for i in row["inventario"]:
+        entry = {"nome": i["nome"], "peso": i["peso"], "quantidade": i["quantidade"]}
+        if i["municao_max"] is not None:
+            entry["municao_atual"] = i["municao_atual"]
+            entry["municao_max"] = i["municao_max"]
+        player["inventario"].append(entry)
+    return player
+
+def get_players(uids):
+    """Carrega vários jogadores (ficha + inventário) num único SELECT. Retorna {id: player}."""
+    players = {}
+    faltando = []
+    for uid in set(uids):
+        player = PLAYER_CACHE.get(uid)
+        if player is None:
+            faltando.append(uid)
+        else:
+            players[uid] = player
+    if faltando:
+        geracao = PLAYER_CACHE.geracao()
+        with conexao() as conn:
+            c = conn.cursor()
+            c.execute(PLAYER_SNAPSHOT_SQL, (faltando,))
+            rows = c.fetchall()
+        for row in rows:
+            player = _player_from_row(row)
+            PLAYER_CACHE.set(player["id"], player, geracao)
+            players[player["id"]] = player
+    # Cópias, para que quem chama possa alterar o dict sem sujar o cache.
+    # fome/sede/sono dependem do relógio, então são calculados a cada leitura.
+    agora = datetime.now()
+    resultado = {}
+    for uid, p in players.items():
+        p = copy.deepcopy(p)
+        p.update(necessidades_atuais(p, agora))
+        p["rerolls"] = rerolls_disponiveis(p, agora)
+        resultado[uid] = p
+    return resultado
 
 def get_player(uid):
-    conn = None
-    try:
-        conn = get_conn()
-        c = conn.cursor()
-        c.execute("SELECT * FROM players WHERE id=%s", (uid,))
-        row = c.fetchone()
-        if not row:
-            return None
-        player = {
-            "id": row["id"],
-            "nome": row["nome"],
-            "username": row["username"],
-            "peso_max": row["peso_max"],
-            "hp": row["hp"],
-            "hp_max": row["hp_max"],
-            "sp": row["sp"],
-            "sp_max": row["sp_max"],
-            "rerolls": row["rerolls"],
-            "fome": row["fome"],
-            "sede": row["sede"],
-            "sono": row["sono"],
-            "traumas": row.get("traumas", ""),
-            "atributos": {},
-            "pericias": {},
-            "inventario": []
-        }
-        c.execute("SELECT nome, valor FROM atributos WHERE player_id=%s", (uid,))
-        for a, v in c.fetchall():
-            player["atributos"][a] = v
-        c.execute("SELECT nome, valor FROM pericias WHERE player_id=%s", (uid,))
-        for a, v in c.fetchall():
-            player["pericias"][a] = v
-        c.execute("SELECT nome,peso,quantidade,municao_atual,municao_max FROM inventario WHERE player_id=%s", (uid,))
-        for n, p, q, mun_at, mun_max in c.fetchall():
-            entry = {"nome": n, "peso": p, "quantidade": q}
-            if mun_max is not None:
-                entry["municao_atual"] = mun_at
-                entry["municao_max"] = mun_max
-            player["inventario"].append(entry)
-        return player
-    finally:
-        if conn:
-            put_conn(conn)
+    return get_players([uid]).get(uid)
 
 def resistencia_horas_max(resistencia):
     tabela = {1: 24, 2: 36, 3: 48, 4: 60, 5: 78, 6: 96}
     return tabela.get(max(1, min(6, resistencia)), 24)
 
-def get_horas_sem_recursos(uid):
-    conn = None
-    try:
-        conn = get_conn()
-        c = conn.cursor()
-        c.execute("SELECT ultimo_alimento, ultima_agua, ultimo_sono FROM players WHERE id=%s", (uid,))
-        row = c.fetchone()
-    finally:
-        if conn:
-            put_conn(conn)
-    agora = datetime.now()
-    if not row:
-        return (None, None, None)
-    ua, ug, us = row
-    horas_sem_comer = (agora - ua).total_seconds()/3600 if ua else None
-    horas_sem_beber = (agora - ug).total_seconds()/3600 if ug else None
-    horas_sem_dormir = (agora - us).total_seconds()/3600 if us else None
-    return (horas_sem_comer, horas_sem_beber, horas_sem_dormir)
-
-def registrar_consumo(uid, tipo):
-    now = datetime.now()
-    conn = None
-    try:
-        conn = get_conn()
-        c = conn.cursor()
-        if tipo == "comida":
-            c.execute("UPDATE players SET ultimo_alimento=%s WHERE id=%s", (now, uid))
-        elif tipo == "bebida":
-            c.execute("UPDATE players SET ultima_agua=%s WHERE id=%s", (now, uid))
-        elif tipo == "sono":
-            c.execute("UPDATE players SET ultimo_sono=%s WHERE id=%s", (now, uid))
-        conn.commit()
-    finally:
-        if conn:
-            put_conn(conn)
+CONSUMO_COLUNAS = {"comida": "ultimo_alimento", "bebida": "ultima_agua", "sono": "ultimo_sono"}
+NECESSIDADE_CONSUMO = {"fome": "comida", "sede": "bebida", "sono": "sono"}
+
+def get_horas_sem_recursos(player, agora=None):
+    """Horas desde a última refeição, bebida e sono (None se nunca registrado)."""
+    agora = agora or datetime.now()
+    return tuple(
+        max(0.0, (agora - player[col]).total_seconds() / 3600) if player.get(col) else None
+        for col in ("ultimo_alimento", "ultima_agua", "ultimo_sono")
+    )
+
+def necessidades_atuais(player, agora=None):
+    """fome/sede/sono (0..100): proporção do tempo máximo da Resistência já passada + ajustes.
+
+    Função pura sobre o snapshot; ler o status não grava nada.
+    """
+    max_horas = resistencia_horas_max(player["pericias"].get("Resistência", 1))
+    horas = get_horas_sem_recursos(player, agora)
+    valores = {}
+    for chave, h in zip(("fome", "sede", "sono"), horas):
+        base = 0 if h is None else min(100, int(100 * (h / max_horas)))
+        valores[chave] = min(100, max(0, base + player.get(f"ajuste_{chave}", 0)))
+    return valores
 
 def vitalidade_para_hp(v):
     return [10, 15, 20, 25, 30, 35, 40][max(0, min(6, v))]
@@ -421,29 +1387,94 @@ def faixa_status(val, tipo="fome"):
     else:
         return "crítica"
 
-def update_necessidades(uid, fome_delta=0, sede_delta=0, sono_delta=0):
-    conn = None
-    try:
-        conn = get_conn()
+NECESSIDADES_COLUNAS = (
+    "ultimo_alimento, ultima_agua, ultimo_sono, ajuste_fome, ajuste_sede, ajuste_sono, "
+    "(SELECT valor FROM pericias WHERE player_id = players.id AND nome = 'Resistência') AS resistencia"
+)
+
+def _estado_necessidades(row):
+    """Monta, de uma linha de NECESSIDADES_COLUNAS, o mínimo que necessidades_atuais lê."""
+    return {
+        "ultimo_alimento": row[0], "ultima_agua": row[1], "ultimo_sono": row[2],
+        "ajuste_fome": row[3] or 0, "ajuste_sede": row[4] or 0, "ajuste_sono": row[5] or 0,
+        "pericias": {"Resistência": row[6] if row[6] is not None else 1},
+    }
+
+def _base_necessidades(estado, agora):
+    """Só a parte que vem do tempo (ajustes zerados)."""
+    return necessidades_atuais({**estado, "ajuste_fome": 0, "ajuste_sede": 0, "ajuste_sono": 0}, agora)
+
+def migrar_necessidades_legadas(c):
+    """fome/sede/sono guardavam o nível absoluto, regravado a cada leitura.
+
+    Uma vez por jogador, a diferença entre esse nível e o calculado pelo tempo vira
+    ajuste e a coluna fica NULL; as linhas novas já nascem NULL. Um ajuste já
+    diferente de zero foi gravado depois do nível antigo e é mantido.
+    """
+    c.execute("ALTER TABLE players ALTER COLUMN fome DROP DEFAULT, ALTER COLUMN sede DROP DEFAULT, ALTER COLUMN sono DROP DEFAULT")
+    c.execute(
+        f"SELECT {NECESSIDADES_COLUNAS}, fome, sede, sono, id FROM players "
+        "WHERE fome IS NOT NULL OR sede IS NOT NULL OR sono IS NOT NULL"
+    )
+    agora = datetime.now()
+    ajustes = []
+    for row in c.fetchall():
+        estado = _estado_necessidades(row)
+        base = _base_necessidades(estado, agora)
+        novos = []
+        for chave, legado in zip(("fome", "sede", "sono"), row[7:10]):
+            ajuste = estado[f"ajuste_{chave}"]
+            if legado is not None and not ajuste:
+                ajuste = max(-100, min(100, legado - base[chave]))
+            novos.append(ajuste)
+        ajustes.append((*novos, row[10]))
+    if ajustes:
+        c.executemany(
+            "UPDATE players SET ajuste_fome=%s, ajuste_sede=%s, ajuste_sono=%s, fome=NULL, sede=NULL, sono=NULL WHERE id=%s",
+            ajustes
+        )
+        logger.info(f"🍽️ Fome/sede/sono de {len(ajustes)} jogadores convertidos em ajustes")
+
+def update_necessidades(uid, fome_delta=0, sede_delta=0, sono_delta=0, consumo=None):
+    """Soma deltas a fome/sede/sono a partir do valor atual (tempo + ajuste), numa transação.
+
+    O ajuste gravado é o que falta para o valor calculado pelo tempo chegar ao novo
+    valor. consumo ("comida", "bebida" ou "sono") marca o horário da necessidade
+    correspondente: o tempo volta a contar dali e o que sobrou dela fica como ajuste.
+    Retorna {"fome", "sede", "sono"} atuais, ou None se o jogador não existe.
+    """
+    agora = datetime.now()
+    deltas = {"fome": fome_delta, "sede": sede_delta, "sono": sono_delta}
+    with conexao() as conn:
         c = conn.cursor()
-        c.execute("SELECT fome, sede, sono FROM players WHERE id=%s", (uid,))
+        c.execute(f"SELECT {NECESSIDADES_COLUNAS} FROM players WHERE id=%s FOR UPDATE", (uid,))
         row = c.fetchone()
         if not row:
-            return
-        fome, sede, sono = row
-        fome = min(100, max(0, fome + fome_delta))
-        sede = min(100, max(0, sede + sede_delta))
-        sono = min(100, max(0, sono + sono_delta))
-        c.execute("UPDATE players SET fome=%s, sede=%s, sono=%s WHERE id=%s", (fome, sede, sono, uid))
-        conn.commit()
-    finally:
-        if conn:
-            put_conn(conn)
+            return None
+        estado = _estado_necessidades(row)
+        atuais = necessidades_atuais(estado, agora)
+        base = _base_necessidades(estado, agora)
+        sets = []
+        params = []
+        for chave, delta in deltas.items():
+            consumido = NECESSIDADE_CONSUMO[chave] == consumo
+            if not delta and not consumido:
+                continue
+            atuais[chave] = min(100, max(0, atuais[chave] + delta))
+            if consumido:
+                sets.append(f"{CONSUMO_COLUNAS[consumo]}=%s")
+                params.append(agora)
+                base[chave] = 0
+            sets.append(f"ajuste_{chave}=%s")
+            params.append(atuais[chave] - base[chave])
+        if sets:
+            c.execute(f"UPDATE players SET {', '.join(sets)} WHERE id=%s", params + [uid])
+            conn.commit()
+            PLAYER_CACHE.invalidate(uid)
+    return atuais
 
 def create_player(uid, nome, username=None):
-    conn = None
-    try:
-        conn = get_conn()
+    with conexao() as conn:
         c = conn.cursor()
         c.execute(
             "INSERT INTO players(id, nome, username, hp, sp, hp_max, sp_max) VALUES(%s, %s, %s, %s, %s, %s, %s) "
@@ -455,232 +1486,295 @@ def create_player(uid, nome, username=None):
         for p in PERICIAS_LISTA:
             c.execute("INSERT INTO pericias(player_id, nome, valor) VALUES(%s, %s, %s) ON CONFLICT DO NOTHING", (uid, p, 0))
         conn.commit()
-    finally:
-        if conn:
-            put_conn(conn)
+        PLAYER_CACHE.invalidate(uid)
 
 def update_player_field(uid, field, value):
-    conn = None
-    try:
-        conn = get_conn()
+    with conexao() as conn:
         c = conn.cursor()
         c.execute(f"UPDATE players SET {field}=%s WHERE id=%s", (value, uid))
         conn.commit()
-    finally:
-        if conn:
-            put_conn(conn)
+        PLAYER_CACHE.invalidate(uid)
 
-def update_atributo(uid, nome, valor):
-    conn = None
-    try:
-        conn = get_conn()
-        c = conn.cursor()
-        c.execute("UPDATE atributos SET valor=%s WHERE player_id=%s AND nome=%s", (valor, uid, nome))
-        conn.commit()
-    finally:
-        if conn:
-            put_conn(conn)
+def alterar_vitais(uid, hp=None, sp=None):
+    """Soma deltas a HP/SP no banco, sem sobrescrever alterações simultâneas.
 
-def update_pericia(uid, nome, valor):
-    conn = None
-    try:
-        conn = get_conn()
+    Delta positivo (cura) para no máximo; negativo (dano) para em 0.
+    Retorna {"hp": (antes, depois), "sp": (antes, depois)}, ou None se o jogador não existe.
+    """
+    sets, params = [], []
+    for campo, delta in (("hp", hp), ("sp", sp)):
+        if delta is None:
+            continue
+        if delta >= 0:
+            sets.append(f"{campo} = LEAST({campo}_max, {campo} + %s)")
+        else:
+            sets.append(f"{campo} = GREATEST(0, {campo} + %s)")
+        params.append(delta)
+    with conexao() as conn:
         c = conn.cursor()
-        c.execute("UPDATE pericias SET valor=%s WHERE player_id=%s AND nome=%s", (valor, uid, nome))
+        c.execute("SELECT hp, sp FROM players WHERE id=%s FOR UPDATE", (uid,))
+        antes = c.fetchone()
+        if not antes:
+            return None
+        c.execute(f"UPDATE players SET {', '.join(sets)} WHERE id=%s RETURNING hp, sp", params + [uid])
+        depois = c.fetchone()
         conn.commit()
-    finally:
-        if conn:
-            put_conn(conn)
-
-def atualizar_necessidades_por_tempo(uid):
-    player = get_player(uid)
-    resistencia = player["pericias"].get("Resistência", 1)
-    max_horas = resistencia_horas_max(resistencia)
-    horas_sem_comer, horas_sem_beber, horas_sem_dormir = get_horas_sem_recursos(uid)
-    fome = player.get("fome", 0)
-    sede = player.get("sede", 0)
-    sono = player.get("sono", 0)
-
-    if horas_sem_comer is not None:
-        if horas_sem_comer >= max_horas:
-            fome = 100
-        else:
-            fome = int(100 * (horas_sem_comer / max_horas))
-        update_player_field(uid, "fome", fome)
-    if horas_sem_beber is not None:
-        if horas_sem_beber >= max_horas:
-            sede = 100
-        else:
-            sede = int(100 * (horas_sem_beber / max_horas))
-        update_player_field(uid, "sede", sede)
-    if horas_sem_dormir is not None:
-        if horas_sem_dormir >= max_horas:
-            sono = 100
-        else:
-            sono = int(100 * (horas_sem_dormir / max_horas))
-        update_player_field(uid, "sono", sono)
+    PLAYER_CACHE.invalidate(uid)
+    return {"hp": (antes[0], depois[0]), "sp": (antes[1], depois[1])}
 
 def update_inventario(uid, item):
-    conn = None
-    try:
-        conn = get_conn()
+    with conexao() as conn:
         c = conn.cursor()
-        c.execute("SELECT quantidade FROM inventario WHERE player_id=%s AND LOWER(nome)=LOWER(%s)", (uid, item['nome']))
+        norm = normalizar(item['nome'])
+        c.execute("SELECT quantidade FROM inventario WHERE player_id=%s AND nome_norm=%s", (uid, norm))
         row = c.fetchone()
         if row:
-            c.execute("UPDATE inventario SET quantidade=%s, peso=%s WHERE player_id=%s AND LOWER(nome)=LOWER(%s)",
-                      (item['quantidade'], item['peso'], uid, item['nome']))
+            c.execute("UPDATE inventario SET quantidade=%s, peso=%s WHERE player_id=%s AND nome_norm=%s",
+                      (item['quantidade'], item['peso'], uid, norm))
         else:
-            c.execute("INSERT INTO inventario(player_id, nome, peso, quantidade) VALUES (%s, %s, %s, %s)",
-                      (uid, item['nome'], item['peso'], item['quantidade']))
+            c.execute("INSERT INTO inventario(player_id, nome, nome_norm, peso, quantidade) VALUES (%s, %s, %s, %s, %s)",
+                      (uid, item['nome'], norm, item['peso'], item['quantidade']))
         conn.commit()
-    finally:
-        if conn:
-            put_conn(conn)
+        PLAYER_CACHE.invalidate(uid)
     
 def buscar_item_inventario(uid, nome_procurado):
-    conn = None
-    try:
-        conn = get_conn()
+    with conexao() as conn:
         c = conn.cursor()
-        c.execute("SELECT nome, peso, quantidade FROM inventario WHERE player_id=%s", (uid,))
-        rows = c.fetchall()
-    finally:
-        if conn:
-            put_conn(conn)
-    for nome, peso, quantidade in rows:
-        if normalizar(nome) == normalizar(nome_procurado):
-            return nome, peso, quantidade
+        c.execute(
+            "SELECT nome, peso, quantidade FROM inventario WHERE player_id=%s AND nome_norm=%s LIMIT 1",
+            (uid, normalizar(nome_procurado))
+        )
+        row = c.fetchone()
+    if row:
+        return row[0], row[1], row[2]
     return None, None, None
 
-def adjust_item_quantity(uid, item_nome, delta):
-    conn = None
-    try:
-        conn = get_conn()
+def alterar_quantidade(c, uid, item_norm, delta, minimo=None):
+    """Soma delta à quantidade do item, na transação do cursor c, sem ler antes.
+
+    Com minimo, só altera se o jogador tiver pelo menos essa quantidade.
+    Linhas que chegam a zero (ou menos) são apagadas. Retorna
+    (quantidade_nova, municao_atual, municao_max), com quantidade 0 se a linha
+    foi apagada, ou None se o item não existe ou não havia o mínimo.
+    """
+    sql = ("UPDATE inventario SET quantidade = quantidade + %s "
+           "WHERE player_id=%s AND nome_norm=%s")
+    params = [delta, uid, item_norm]
+    if minimo is not None:
+        sql += " AND quantidade >= %s"
+        params.append(minimo)
+    c.execute(sql + " RETURNING quantidade, municao_atual, municao_max", params)
+    row = c.fetchone()
+    if not row:
+        return None
+    quantidade, municao_atual, municao_max = row
+    if quantidade <= 0:
+        c.execute(
+            "DELETE FROM inventario WHERE player_id=%s AND nome_norm=%s AND quantidade <= 0",
+            (uid, item_norm)
+        )
+        quantidade = 0
+    return quantidade, municao_atual, municao_max
+
+def adjust_item_quantity(uid, item_nome, delta, minimo=None):
+    """Altera a quantidade num único UPDATE; com minimo, False se o jogador não tiver o bastante."""
+    with conexao() as conn:
         c = conn.cursor()
-        c.execute("SELECT quantidade, peso FROM inventario WHERE player_id=%s AND LOWER(nome)=LOWER(%s)", (uid, item_nome))
-        row = c.fetchone()
-        if not row:
+        resultado = alterar_quantidade(c, uid, normalizar(item_nome), delta, minimo)
+        if resultado is None:
             return False
-        qtd, peso = row
-        nova = qtd + delta
-        if nova <= 0:
-            c.execute("DELETE FROM inventario WHERE player_id=%s AND LOWER(nome)=LOWER(%s)", (uid, item_nome))
-        else:
-            c.execute("UPDATE inventario SET quantidade=%s WHERE player_id=%s AND LOWER(nome)=LOWER(%s)", (nova, uid, item_nome))
         conn.commit()
+        PLAYER_CACHE.invalidate(uid)
         return True
-    finally:
-        if conn:
-            put_conn(conn)
 
 def get_catalog_item(nome: str):
-    conn = None
-    try:
-        conn = get_conn()
-        c = conn.cursor()
-        c.execute("SELECT nome, peso, consumivel, bonus, tipo, arma_tipo, arma_bonus, muni_atual, muni_max, armas_compat, rest_hunger, rest_thirst FROM catalogo WHERE LOWER(nome)=LOWER(%s)", (nome,))
-        row = c.fetchone()
-    finally:
-        if conn:
-            put_conn(conn)
-    if not row:
-        return None
-    return {
-        "nome": row[0], "peso": row[1], "consumivel": row[2], "bonus": row[3], "tipo": row[4],
-        "arma_tipo": row[5], "arma_bonus": row[6], "muni_atual": row[7], "muni_max": row[8], "armas_compat": row[9],
-        "rest_hunger": row[10], "rest_thirst": row[11]
-    }
+    """Busca no catálogo em memória (sem I/O)."""
+    return CATALOGO.get(nome)
 
 def add_catalog_item(nome: str, peso: float, consumivel: bool = False, bonus: str = '0', tipo: str = '', arma_tipo: str = '', arma_bonus: str = '0', muni_atual: int = 0, muni_max: int = 0, armas_compat: str = '', rest_hunger: int = 0, rest_thirst: int = 0):
-    conn = None
-    try:
-        conn = get_conn()
+    with conexao() as conn:
         c = conn.cursor()
         c.execute(
-            "INSERT INTO catalogo(nome,peso,consumivel,bonus,tipo,arma_tipo,arma_bonus,muni_atual,muni_max,armas_compat,rest_hunger,rest_thirst) VALUES(%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s) "
+            "INSERT INTO catalogo(nome,nome_norm,peso,consumivel,bonus,tipo,arma_tipo,arma_bonus,muni_atual,muni_max,armas_compat,rest_hunger,rest_thirst) VALUES(%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s) "
             "ON CONFLICT (nome) DO UPDATE SET peso=%s, consumivel=%s, bonus=%s, tipo=%s, arma_tipo=%s, arma_bonus=%s, muni_atual=%s, muni_max=%s, armas_compat=%s, rest_hunger=%s, rest_thirst=%s",
-            (nome, peso, consumivel, bonus, tipo, arma_tipo, arma_bonus, muni_atual, muni_max, armas_compat, rest_hunger, rest_thirst,
+            (nome, normalizar(nome), peso, consumivel, bonus, tipo, arma_tipo, arma_bonus, muni_atual, muni_max, armas_compat, rest_hunger, rest_thirst,
              peso, consumivel, bonus, tipo, arma_tipo, arma_bonus, muni_atual, muni_max, armas_compat, rest_hunger, rest_thirst)
         )
+        incrementar_versao(c, "catalogo")
         conn.commit()
-    finally:
-        if conn:
-            put_conn(conn)
+    CATALOGO.carregar()
 
 def del_catalog_item(nome: str) -> bool:
-    conn = None
-    try:
-        conn = get_conn()
+    with conexao() as conn:
         c = conn.cursor()
-        c.execute("DELETE FROM catalogo WHERE LOWER(nome)=LOWER(%s)", (nome,))
+        c.execute("DELETE FROM catalogo WHERE nome_norm=%s", (normalizar(nome),))
         deleted = c.rowcount
+        if deleted:
+            incrementar_versao(c, "catalogo")
         conn.commit()
-        return deleted > 0
-    finally:
-        if conn:
-            put_conn(conn)
+    if deleted:
+        CATALOGO.carregar()
+    return deleted > 0
 
 def list_catalog():
-    conn = None
-    try:
-        conn = get_conn()
-        c = conn.cursor()
-        c.execute("SELECT nome,peso,consumivel,bonus,tipo,arma_tipo,arma_bonus,muni_atual,muni_max,armas_compat FROM catalogo ORDER BY nome COLLATE \"C\"")
-        data = c.fetchall()
-        return data
-    finally:
-        if conn:
-            put_conn(conn)
+    return CATALOGO.listar()
     
+def get_pending_consumivel(uid):
+    with conexao() as conn:
+        c = conn.cursor()
+        c.execute("SELECT nome, peso, bonus, armas_compat FROM pending_consumivel WHERE user_id=%s", (uid,))
+        return c.fetchone()
+
+def set_pending_consumivel(uid, nome, peso, bonus, armas_compat):
+    with conexao() as conn:
+        c = conn.cursor()
+        c.execute('''INSERT INTO pending_consumivel (user_id, nome, peso, bonus, armas_compat)
+                     VALUES (%s, %s, %s, %s, %s)
+                     ON CONFLICT (user_id) DO UPDATE SET nome=%s, peso=%s, bonus=%s, armas_compat=%s, created_at=NOW()''',
+                  (uid, nome, peso, bonus, armas_compat, nome, peso, bonus, armas_compat))
+        conn.commit()
+
+def del_pending_consumivel(uid):
+    with conexao() as conn:
+        c = conn.cursor()
+        c.execute("DELETE FROM pending_consumivel WHERE user_id=%s", (uid,))
+        conn.commit()
+
 def add_weapon_to_inventory(uid, nome, peso, quantidade, municao_atual, municao_max):
-    conn = None
-    try:
-        conn = get_conn()
+    with conexao() as conn:
         c = conn.cursor()
         c.execute("""
-            INSERT INTO inventario (player_id, nome, peso, quantidade, municao_atual, municao_max)
-            VALUES (%s, %s, %s, %s, %s, %s)
+            INSERT INTO inventario (player_id, nome, nome_norm, peso, quantidade, municao_atual, municao_max)
+            VALUES (%s, %s, %s, %s, %s, %s, %s)
             ON CONFLICT (player_id, nome) DO UPDATE
             SET quantidade = inventario.quantidade + %s,
                 peso = %s,
                 municao_atual = %s,
                 municao_max = %s
-        """, (uid, nome, peso, quantidade, municao_atual, municao_max, quantidade, peso, municao_atual, municao_max))
+        """, (uid, nome, normalizar(nome), peso, quantidade, municao_atual, municao_max, quantidade, peso, municao_atual, municao_max))
         conn.commit()
-    finally:
-        if conn:
-            put_conn(conn)
+        PLAYER_CACHE.invalidate(uid)
 
-def update_weapon_ammo(uid, nome, nova_municao):
-    conn = None
-    try:
-        conn = get_conn()
+def gastar_municao(uid, nome) -> bool:
+    """Consome 1 bala da arma; retorna False se ela estiver descarregada."""
+    nome = normalizar(nome)
+    with conexao() as conn:
         c = conn.cursor()
-        c.execute("""
-            UPDATE inventario
-            SET municao_atual = %s
-            WHERE player_id = %s AND nome = %s
-        """, (nova_municao, uid, nome))
+        c.execute(
+            "UPDATE inventario SET municao_atual = municao_atual - 1 "
+            "WHERE player_id=%s AND nome_norm=%s AND municao_atual > 0 RETURNING municao_atual",
+            (uid, nome)
+        )
+        if not c.fetchone():
+            return False
         conn.commit()
-    finally:
-        if conn:
-            put_conn(conn)
+        PLAYER_CACHE.invalidate(uid)
+        return True
 
 def is_consumivel_catalogo(nome: str):
     item = get_catalog_item(nome)
     return item and item.get("consumivel")
 
 def remove_item(uid, item_nome):
-    conn = None
-    try:
-        conn = get_conn()
+    item_nome = normalizar(item_nome)
+    with conexao() as conn:
         c = conn.cursor()
-        c.execute("DELETE FROM inventario WHERE player_id=%s AND LOWER(nome)=LOWER(%s)", (uid, item_nome))
+        c.execute("DELETE FROM inventario WHERE player_id=%s AND nome_norm=%s", (uid, item_nome))
         conn.commit()
-    finally:
-        if conn:
-            put_conn(conn)
+        PLAYER_CACHE.invalidate(uid)
+
+def transferir_item(doador, alvo, item, qtd):
+    """Move o item do doador para o alvo numa transação. Retorna "ok", "sem_item" ou "sem_catalogo"."""
+    norm = normalizar(item)
+    item_info = get_catalog_item(item)
+    with conexao() as conn:
+        c = conn.cursor()
+        retirado = alterar_quantidade(c, doador, norm, -qtd, minimo=qtd)
+        if not retirado:
+            if not is_admin(doador):
+                return "sem_item"
+            # Admin sem o item dá a partir do catálogo; com o item, mas sem o bastante, não
+            c.execute("SELECT 1 FROM inventario WHERE player_id=%s AND nome_norm=%s", (doador, norm))
+            if c.fetchone():
+                return "sem_item"
+        if not item_info:
+            # Sai sem commit: a retirada do doador é desfeita
+            return "sem_catalogo"
+        if retirado:
+            _, municao_atual, municao_max = retirado
+        else:
+            municao_atual = item_info.get("muni_atual", 0)
+            municao_max = item_info.get("muni_max", 0)
+
+        c.execute(
+            "UPDATE inventario SET quantidade = quantidade + %s, peso=%s, consumivel=%s, bonus=%s, tipo=%s, arma_tipo=%s, arma_bonus=%s, municao_atual=%s, municao_max=%s, armas_compat=%s WHERE player_id=%s AND nome_norm=%s",
+            (
+                qtd, item_info["peso"],
+                item_info.get("consumivel", False),
+                item_info.get("bonus", '0'),
+                item_info.get("tipo", ""),
+                item_info.get("arma_tipo", ""),
+                item_info.get("arma_bonus", '0'),
+                municao_atual,
+                municao_max,
+                item_info.get("armas_compat", ""),
+                alvo, norm
+            )
+        )
+        if c.rowcount == 0:
+            c.execute(
+                "INSERT INTO inventario(player_id, nome, nome_norm, peso, quantidade, consumivel, bonus, tipo, arma_tipo, arma_bonus, municao_atual, municao_max, armas_compat) VALUES(%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s) "
+                "ON CONFLICT (player_id, nome) DO UPDATE SET quantidade = inventario.quantidade + EXCLUDED.quantidade",
+                (
+                    alvo, item_info["nome"], normalizar(item_info["nome"]), item_info["peso"], qtd,
+                    item_info.get("consumivel", False),
+                    item_info.get("bonus", '0'),
+                    item_info.get("tipo", ""),
+                    item_info.get("arma_tipo", ""),
+                    item_info.get("arma_bonus", '0'),
+                    municao_atual,
+                    municao_max,
+                    item_info.get("armas_compat", "")
+                )
+            )
+
+        conn.commit()
+        PLAYER_CACHE.invalidate(doador)
+        PLAYER_CACHE.invalidate(alvo)
+        return "ok"
+
+def abandonar_item(uid, item_nome, qtd) -> bool:
+    with conexao() as conn:
+        c = conn.cursor()
+        # Abandonar mais do que tem descarta tudo: a linha chega a zero e é apagada
+        if alterar_quantidade(c, uid, normalizar(item_nome), -qtd) is None:
+            return False
+        conn.commit()
+        PLAYER_CACHE.invalidate(uid)
+        return True
+
+def recarregar_arma(uid, municao, arma, qtd):
+    """Gasta a munição e carrega a arma. Retorna (mun_antes, mun_depois, mun_max) ou "sem_municao"/"sem_arma"."""
+    with conexao() as conn:
+        c = conn.cursor()
+        if alterar_quantidade(c, uid, normalizar(municao), -qtd, minimo=qtd) is None:
+            return "sem_municao"
+
+        # "antes" enxerga a linha como estava antes deste UPDATE
+        c.execute(
+            "UPDATE inventario i SET municao_atual = LEAST(i.municao_max, COALESCE(i.municao_atual, 0) + %s) "
+            "FROM inventario antes "
+            "WHERE i.player_id=%s AND i.nome_norm=%s AND antes.player_id = i.player_id AND antes.nome = i.nome "
+            "RETURNING COALESCE(antes.municao_atual, 0), i.municao_atual, i.municao_max",
+            (qtd, uid, normalizar(arma))
+        )
+        row = c.fetchone()
+        if not row:
+            conn.rollback()
+            return "sem_arma"
+        conn.commit()
+        PLAYER_CACHE.invalidate(uid)
+        return tuple(row)
 
 def peso_total(player):
     return sum(i['peso'] * i.get('quantidade', 1) for i in player.get("inventario", []))
@@ -699,12 +1793,10 @@ def penalidade_sobrecarga(player):
     else:
         return -3
 
-def anti_spam(user_id):
-    now = time.time()
-    if user_id in LAST_COMMAND and now - LAST_COMMAND[user_id] < COOLDOWN:
-        return False
-    LAST_COMMAND[user_id] = now
-    return True
+async def anti_spam(update, comando):
+    """Confere o limite de taxa do comando para o usuário, o chat e o bot todo."""
+    chat = update.effective_chat
+    return await LIMITES.permitir(comando, update.effective_user.id, chat.id if chat else None)
 
 def parse_dice_notation(notation):
     if not isinstance(notation, str):
@@ -751,38 +1843,65 @@ def parse_float_br(s: str) -> float | None:
     except:
         return None
 
-def ensure_peso_max_by_forca(uid: int):
-    conn = None
-    try:
-        conn = get_conn()
-        c = conn.cursor()
-        c.execute("SELECT valor FROM atributos WHERE player_id=%s AND nome='Força'", (uid,))
-        row = c.fetchone()
-        if row:
-            valor_forca = max(1, min(6, int(row[0])))
-            novo = PESO_MAX.get(valor_forca, 0)
-            c.execute("UPDATE players SET peso_max=%s WHERE id=%s", (novo, uid))
+class EdicaoFicha:
+    """Unidade de trabalho do /editarficha: junta só o que mudou e grava tudo numa transação."""
+
+    def __init__(self, player):
+        self.uid = player["id"]
+        self.player = player
+        self.atributos = {}
+        self.pericias = {}
+
+    def valor(self, nome):
+        if nome in ATRIBUTOS_LISTA:
+            return self.atributos.get(nome, self.player["atributos"].get(nome, 0))
+        return self.pericias.get(nome, self.player["pericias"].get(nome, 0))
+
+    def alterar(self, nome, valor):
+        if nome in ATRIBUTOS_LISTA:
+            alvo, atual = self.atributos, self.player["atributos"].get(nome)
+        else:
+            alvo, atual = self.pericias, self.player["pericias"].get(nome)
+        if valor == atual:
+            alvo.pop(nome, None)
+        else:
+            alvo[nome] = valor
+
+    def gravar(self):
+        forca = max(1, min(6, int(self.valor("Força"))))
+        hp_max = vitalidade_para_hp(self.valor("Vitalidade"))
+        sp_max = equilibrio_para_sp(self.valor("Equilíbrio"))
+        peso_max = PESO_MAX.get(forca, 0)
+        with conexao() as conn:
+            c = conn.cursor()
+            for tabela, alteracoes in (("atributos", self.atributos), ("pericias", self.pericias)):
+                if not alteracoes:
+                    continue
+                c.execute(
+                    f"INSERT INTO {tabela} (player_id, nome, valor) "
+                    "SELECT %s, v.nome, v.valor FROM unnest(%s::text[], %s::int[]) AS v(nome, valor) "
+                    "ON CONFLICT (player_id, nome) DO UPDATE SET valor = EXCLUDED.valor",
+                    (self.uid, list(alteracoes), list(alteracoes.values()))
+                )
+            c.execute(
+                "UPDATE players SET hp_max=%(hp_max)s, sp_max=%(sp_max)s, peso_max=%(peso_max)s, "
+                "hp = CASE WHEN hp = 0 OR hp > %(hp_max)s THEN %(hp_max)s ELSE hp END, "
+                "sp = CASE WHEN sp = 0 OR sp > %(sp_max)s THEN %(sp_max)s ELSE sp END "
+                "WHERE id=%(uid)s",
+                {"hp_max": hp_max, "sp_max": sp_max, "peso_max": peso_max, "uid": self.uid}
+            )
             conn.commit()
-    finally:
-        if conn:
-            put_conn(conn)
+            PLAYER_CACHE.invalidate(self.uid)
 
 def add_coma_bonus(target_id: int, delta: int):
-    conn = None
-    try:
-        conn = get_conn()
+    with conexao() as conn:
         c = conn.cursor()
         c.execute("INSERT INTO coma_bonus(target_id, bonus) VALUES(%s,0) ON CONFLICT (target_id) DO NOTHING", (target_id,))
         c.execute("UPDATE coma_bonus SET bonus = bonus + %s WHERE target_id=%s", (delta, target_id))
         conn.commit()
-    finally:
-        if conn:
-            put_conn(conn)
 
 def pop_coma_bonus(target_id: int) -> int:
-    conn = None
-    try:
-        conn = get_conn()
+    with conexao() as conn:
         c = conn.cursor()
         c.execute("SELECT bonus FROM coma_bonus WHERE target_id=%s", (target_id,))
         row = c.fetchone()
@@ -790,45 +1909,21 @@ def pop_coma_bonus(target_id: int) -> int:
         c.execute("DELETE FROM coma_bonus WHERE target_id=%s", (target_id,))
         conn.commit()
         return bonus
-    finally:
-        if conn:
-            put_conn(conn)
 
 def registrar_teste_coma(uid: int) -> bool:
-    hoje = datetime.now().date()
-    conn = None
-    try:
-        conn = get_conn()
+    """Registra o teste de coma do dia de jogo; False se o jogador já fez um hoje."""
+    with conexao() as conn:
         c = conn.cursor()
-        c.execute("SELECT ultima_data FROM coma_teste WHERE player_id=%s", (uid,))
-        row = c.fetchone()
-        if row and row[0] == hoje:
-            return False
-        c.execute("INSERT INTO coma_teste(player_id, ultima_data) VALUES(%s,%s) ON CONFLICT (player_id) DO UPDATE SET ultima_data=%s", (uid, hoje, hoje))
+        c.execute(
+            "INSERT INTO coma_teste(player_id, ultima_data) VALUES(%s,%s) "
+            "ON CONFLICT (player_id) DO UPDATE SET ultima_data = EXCLUDED.ultima_data "
+            "WHERE coma_teste.ultima_data IS DISTINCT FROM EXCLUDED.ultima_data "
+            "RETURNING player_id",
+            (uid, dia_de_jogo())
+        )
+        feito = c.fetchone() is not None
         conn.commit()
-        return True
-    finally:
-        if conn:
-            put_conn(conn)
-
-def reset_coma_teste():
-    while True:
-        now = datetime.now()
-        next_reset = now.replace(hour=6, minute=0, second=0, microsecond=0)
-        if now >= next_reset:
-            next_reset += timedelta(days=1)
-        wait_seconds = (next_reset - now).total_seconds()
-        time.sleep(wait_seconds)
-        conn = None
-        try:
-            conn = get_conn()
-            c = conn.cursor()
-            c.execute("DELETE FROM coma_teste")
-            conn.commit()
-            logger.info("🧊 Resetei testes de coma!")
-        finally:
-            if conn:
-                put_conn(conn)
+        return feito
 
 def parse_nome_quantidade(args):
     if len(args) >= 2 and args[-2].lower() == 'x' and args[-1].isdigit():
@@ -845,28 +1940,46 @@ def parse_nome_quantidade(args):
         nome = " ".join(args)
     return nome.strip(), qtd
 
-def reset_diario_rerolls():
-    while True:
-        try:
-            now = datetime.now()
-            next_reset = now.replace(hour=6, minute=0, second=0, microsecond=0)
-            if now >= next_reset:
-                next_reset += timedelta(days=1)
-            wait_seconds = (next_reset - now).total_seconds()
-            time.sleep(wait_seconds)
-            conn = None
-            try:
-                conn = get_conn()
-                c = conn.cursor()
-                c.execute("UPDATE players SET rerolls=3")
-                conn.commit()
-                logger.info("🔄 Rerolls diários resetados!")
-            finally:
-                if conn:
-                    put_conn(conn)
-        except Exception as e:
-            logger.error(f"Erro no reset de rerolls: {e}")
-            time.sleep(60)
+REROLLS_DIARIOS = 3
+
+def dia_de_jogo(agora=None):
+    """O dia de jogo vira às 06:00: antes disso ainda conta como o dia anterior."""
+    return ((agora or datetime.now()) - timedelta(hours=6)).date()
+
+def rerolls_disponiveis(player, agora=None):
+    if player.get("rerolls_reset") != dia_de_jogo(agora):
+        return REROLLS_DIARIOS
+    return player.get("rerolls", 0)
+
+def gastar_reroll(uid):
+    """Gasta um reroll, recarregando o saldo se for o primeiro uso do dia. Retorna o saldo ou None."""
+    with conexao() as conn:
+        c = conn.cursor()
+        c.execute(
+            "UPDATE players SET "
+            "rerolls = CASE WHEN rerolls_reset IS DISTINCT FROM %(dia)s THEN %(diarios)s ELSE rerolls END - 1, "
+            "rerolls_reset = %(dia)s "
+            "WHERE id = %(uid)s AND (rerolls_reset IS DISTINCT FROM %(dia)s OR rerolls > 0) "
+            "RETURNING rerolls",
+            {"dia": dia_de_jogo(), "diarios": REROLLS_DIARIOS, "uid": uid}
+        )
+        row = c.fetchone()
+        if not row:
+            return None
+        conn.commit()
+        PLAYER_CACHE.invalidate(uid)
+        return row[0]
+
+def devolver_reroll(uid):
+    """Devolve o reroll de uma rolagem que não aconteceu (só vale no mesmo dia de jogo)."""
+    with conexao() as conn:
+        c = conn.cursor()
+        c.execute(
+            "UPDATE players SET rerolls = rerolls + 1 WHERE id=%s AND rerolls_reset=%s",
+            (uid, dia_de_jogo())
+        )
+        conn.commit()
+    PLAYER_CACHE.invalidate(uid)
 
 def is_admin(uid: int) -> bool:
     return uid in ADMIN_IDS
@@ -876,22 +1989,11 @@ def mention(user):
         return f"@{user.username}"
     return user.first_name or "Jogador"
 
-def cleanup_expired_transfers():
-    while True:
-        try:
-            now = time.time()
-            expired_keys = []
-            for key, transfer in TRANSFER_PENDING.items():
-                if now > transfer.get('expires', now):
-                    expired_keys.append(key)
-            
-            for key in expired_keys:
-                TRANSFER_PENDING.pop(key, None)
-                
-            time.sleep(300)
-        except Exception as e:
-            logger.error(f"Erro na limpeza de transferências: {e}")
-            time.sleep(60)
+def sincronizar_caches():
+    """Relê as cópias em memória quando outro processo altera a versão delas."""
+    CATALOGO.sincronizar()
+    LIBERADOS.sincronizar()
+    PLACAR.sincronizar(semana_atual())
 
 def semana_atual():
     hoje = datetime.now()
@@ -918,61 +2020,473 @@ def xp_por_caracteres(n):
     else:
         return 40
 
-def ranking_semanal(context=None):
-    semana = semana_atual()
-    conn = None
-    try:
-        conn = get_conn()
+def turno_ja_registrado(uid, hoje) -> bool:
+    with conexao() as conn:
+        c = conn.cursor()
+        c.execute("SELECT 1 FROM turnos WHERE player_id=%s AND data=%s", (uid, hoje))
+        return bool(c.fetchone())
+
+BONUS_STREAK = {3: 5, 5: 10, 7: 20}
+
+# Grava o turno e soma o XP do dia num só comando. A streak cresce se o último
+# turno da semana foi ontem e volta a 1 caso contrário; o bônus de streak entra
+# no XP do dia, limitado a 25. Sem linha de retorno: o turno de hoje já existia.
+TURNO_SQL = """
+    WITH novo_turno AS (
+        INSERT INTO turnos (player_id, data, caracteres, mencoes)
+        VALUES (%(uid)s, %(hoje)s, %(caracteres)s, %(mencoes)s)
+        ON CONFLICT (player_id, data) DO NOTHING
+        RETURNING player_id
+    ), xp AS (
+        INSERT INTO xp_semana AS x (player_id, semana_inicio, xp_total, streak_atual, ultimo_turno)
+        SELECT player_id, %(semana)s, LEAST(%(xp)s, 25), 1, %(hoje)s FROM novo_turno
+        ON CONFLICT (player_id, semana_inicio) DO UPDATE SET
+            streak_atual = CASE WHEN x.ultimo_turno = EXCLUDED.ultimo_turno - 1 THEN x.streak_atual + 1 ELSE 1 END,
+            xp_total = x.xp_total + LEAST(%(xp)s +
+                CASE CASE WHEN x.ultimo_turno = EXCLUDED.ultimo_turno - 1 THEN x.streak_atual + 1 ELSE 1 END
+                    WHEN 3 THEN 5 WHEN 5 THEN 10 WHEN 7 THEN 20 ELSE 0 END, 25),
+            ultimo_turno = EXCLUDED.ultimo_turno
+        RETURNING x.player_id, x.xp_total, x.streak_atual
+    )
+    SELECT xp.player_id, xp.xp_total, xp.streak_atual, (SELECT nome FROM players WHERE id = xp.player_id)
+    FROM xp
+"""
+
+# Grava as menções do turno e dá +5 XP aos dois lados de cada menção recíproca
+# do dia (quem foi mencionado já tinha mencionado este jogador hoje). Cada par
+# também fica registrado em interacoes_mutuas. Retorna as linhas de XP alteradas.
+MENCOES_SQL = """
+    WITH arestas AS (
+        INSERT INTO turno_mencoes (data, de, para)
+        SELECT %(hoje)s, %(uid)s, unnest(%(ids)s::bigint[])
+        ON CONFLICT DO NOTHING
+    ), reciprocas AS (
+        SELECT de AS outro FROM turno_mencoes
+        WHERE data = %(hoje)s AND para = %(uid)s AND de = ANY(%(ids)s::bigint[])
+    ), pares AS (
+        INSERT INTO interacoes_mutuas (semana_inicio, jogador1, jogador2)
+        SELECT %(semana)s, LEAST(%(uid)s::bigint, outro), GREATEST(%(uid)s::bigint, outro) FROM reciprocas
+        ON CONFLICT DO NOTHING
+    )
+    UPDATE xp_semana x
+    SET xp_total = x.xp_total + 5 * CASE WHEN x.player_id = %(uid)s THEN (SELECT COUNT(*) FROM reciprocas) ELSE 1 END
+    WHERE x.semana_inicio = %(semana)s
+      AND x.player_id IN (SELECT outro FROM reciprocas UNION ALL SELECT %(uid)s::bigint WHERE EXISTS (SELECT 1 FROM reciprocas))
+    RETURNING x.player_id, x.xp_total, x.streak_atual, (SELECT nome FROM players WHERE id = x.player_id)
+"""
+
+def registrar_turno(uid, username, hoje, semana, caracteres, mencoes):
+    """Grava o turno e o XP da semana.
+
+    Retorna (streak_atual, bonus_streak, [(mencionado, mencionado_id)] bonificados),
+    ou None se o jogador já tinha turno hoje.
+    """
+    mencoes_str = ",".join(mencoes) if mencoes else ""
+    xp = xp_por_caracteres(caracteres)
+    # Resolve as menções antes de abrir a transação
+    ids_mencionados = usernames_to_ids(mencoes) if mencoes else {}
+    with conexao() as conn:
+        c = conn.cursor()
+
+        c.execute(TURNO_SQL, {
+            "uid": uid, "hoje": hoje, "semana": semana,
+            "caracteres": caracteres, "mencoes": mencoes_str, "xp": xp,
+        })
+        row = c.fetchone()
+        if not row:
+            # Outro /turno do mesmo jogador entrou antes
+            return None
+        totais = [row]
+        streak_atual = row[2]
+        bonus_streak = BONUS_STREAK.get(streak_atual, 0)
+
+        bonificados = []
+        ids = sorted({mid for mid in ids_mencionados.values() if mid != uid})
+        if ids:
+            c.execute(MENCOES_SQL, {"uid": uid, "hoje": hoje, "semana": semana, "ids": ids})
+            alterados = c.fetchall()
+            totais.extend(alterados)
+            reciprocos = {row[0] for row in alterados} - {uid}
+            bonificados = [(uname, mid) for uname, mid in ids_mencionados.items() if mid in reciprocos]
+
+        versao = incrementar_versao(c, "placar")
+        conn.commit()
+    for pid, xp_total, streak, nome in totais:
+        PLACAR.atualizar(semana, pid, xp_total, streak, nome, versao)
+    return streak_atual, bonus_streak, bonificados
+
+def get_xp_semana(uid, semana):
+    with conexao() as conn:
+        c = conn.cursor()
+        c.execute("SELECT xp_total, streak_atual FROM xp_semana WHERE player_id=%s AND semana_inicio=%s", (uid, semana))
+        row = c.fetchone()
+        xp_total = row[0] if row else 0
+        streak = row[1] if row else 0
+        c.execute("SELECT data, caracteres, mencoes FROM turnos WHERE player_id=%s AND data >= %s ORDER BY data", (uid, semana))
+        return xp_total, streak, c.fetchall()
+
+def get_ranking(semana, uid, limite=10):
+    """Retorna (top, voce): top = [(pid, nome, xp, streak, pos)], voce = a linha de uid se estiver fora do top."""
+    if not PLACAR.atual(semana):
+        PLACAR.carregar(semana)
+    return PLACAR.consultar(uid, limite)
+
+def fechar_semana(semana):
+    """Monta o ranking final da semana. Retorna o texto para os admins.
+
+    O XP da semana fica na partição dela (consultável depois); quem tira
+    semanas antigas do banco é manter_particoes.
+    """
+    with conexao() as conn:
         c = conn.cursor()
         c.execute("SELECT player_id, xp_total FROM xp_semana WHERE semana_inicio=%s ORDER BY xp_total DESC LIMIT 3", (semana,))
         top = c.fetchall()
-        players = {pid: get_player(pid) for pid, _ in top}
-        lines = ["🏆 Ranking Final da Semana:"]
-        medals = ['🥇', '🥈', '🥉']
-        for idx, (pid, xp) in enumerate(top):
-            nome = players[pid]['nome'] if players.get(pid) else f"ID:{pid}"
-            lines.append(f"{medals[idx]} <b>{nome}</b> – XP: {xp}")
-        texto = "\n".join(lines)
-
-        if context:
-            for admin_id in ADMIN_IDS:
+    players = get_players([pid for pid, _ in top])
+    lines = ["🏆 Ranking Final da Semana:"]
+    medals = ['🥇', '🥈', '🥉']
+    for idx, (pid, xp) in enumerate(top):
+        nome = players[pid]['nome'] if players.get(pid) else f"ID:{pid}"
+        lines.append(f"{medals[idx]} <b>{nome}</b> – XP: {xp}")
+    PLACAR.invalidar()
+    return "\n".join(lines)
+
+async def ranking_semanal(ocorrencia):
+    # Roda na segunda às 06:00 (ou depois, na recuperação): fecha a semana que terminou
+    semana = (ocorrencia - timedelta(days=1)).date()
+    semana -= timedelta(days=semana.weekday())
+    texto = await run_db(fechar_semana, semana)
+    for admin_id in ADMIN_IDS:
+        try:
+            await AGENDADOR.bot.send_message(admin_id, texto, parse_mode='HTML')
+        except Exception as e:
+            logger.error(f"Falha ao enviar ranking para admin {admin_id}: {e}")
+
+# ================== AGENDADOR ==================
+class Tarefa:
+    """Uma tarefa do agendador: diária, semanal ou a cada N segundos."""
+
+    def __init__(self, nome, func, hora=None, dia_semana=None, intervalo=None, persistente=False):
+        self.nome = nome
+        self.func = func
+        self.hora = hora
+        self.dia_semana = dia_semana
+        self.intervalo = intervalo
+        # Persistentes gravam a última execução e recuperam a que foi perdida com o bot fora do ar
+        self.persistente = persistente
+        self.proxima = None
+        self.ocorrencia = None
+        self.execucoes = 0
+        self.falhas = 0
+        self.puladas = 0  # ocorrências que outra réplica já executou
+        self.duracao_total = 0.0
+        self.duracao_max = 0.0
+        self.ultima_execucao = None
+        self.ultimo_erro = None
+
+    def _marco(self, quando):
+        h, m = self.hora
+        return quando.replace(hour=h, minute=m, second=0, microsecond=0)
+
+    def proxima_apos(self, quando):
+        if self.intervalo:
+            return quando + timedelta(seconds=self.intervalo)
+        alvo = self._marco(quando)
+        if self.dia_semana is not None:
+            alvo += timedelta(days=(self.dia_semana - alvo.weekday()) % 7)
+            if alvo <= quando:
+                alvo += timedelta(days=7)
+        elif alvo <= quando:
+            alvo += timedelta(days=1)
+        return alvo
+
+    def anterior_a(self, quando):
+        """Última ocorrência agendada até 'quando' (só para tarefas com horário)."""
+        alvo = self._marco(quando)
+        if self.dia_semana is not None:
+            alvo -= timedelta(days=(alvo.weekday() - self.dia_semana) % 7)
+            if alvo > quando:
+                alvo -= timedelta(days=7)
+        elif alvo > quando:
+            alvo -= timedelta(days=1)
+        return alvo
+
+class Agendador:
+    """Executa as tarefas periódicas no event loop do bot, no lugar de threads dormindo."""
+
+    RETRY = 60
+
+    def __init__(self):
+        self.tarefas = {}
+        self.bot = None
+        self._task = None
+
+    def diaria(self, nome, hora, func, persistente=True):
+        self.tarefas[nome] = Tarefa(nome, func, hora=hora, persistente=persistente)
+
+    def semanal(self, nome, dia_semana, hora, func, persistente=True):
+        self.tarefas[nome] = Tarefa(nome, func, hora=hora, dia_semana=dia_semana, persistente=persistente)
+
+    def a_cada(self, nome, segundos, func):
+        self.tarefas[nome] = Tarefa(nome, func, intervalo=segundos)
+
+    def _ler_execucoes(self):
+        with conexao() as conn:
+            c = conn.cursor()
+            c.execute("SELECT nome, ultima_execucao FROM agendamentos")
+            return dict(c.fetchall())
+
+    def _gravar_execucao(self, nome, ocorrencia):
+        """Marca a ocorrência como feita e libera o lease."""
+        with conexao() as conn:
+            c = conn.cursor()
+            c.execute(
+                "INSERT INTO agendamentos (nome, ultima_execucao) VALUES (%s, %s) "
+                "ON CONFLICT (nome) DO UPDATE SET ultima_execucao = GREATEST(agendamentos.ultima_execucao, EXCLUDED.ultima_execucao), "
+                "dono = NULL, lease_ate = NULL",
+                (nome, ocorrencia)
+            )
+            conn.commit()
+
+    def _reservar(self, nome, ocorrencia):
+        """Tenta ficar com a execução desta ocorrência. Retorna "ok", "feita" ou "ocupada".
+
+        Só uma réplica consegue o UPDATE condicional; se ela morrer, o lease vence
+        e outra assume na próxima tentativa.
+        """
+        with conexao() as conn:
+            c = conn.cursor()
+            c.execute(
+                "UPDATE agendamentos SET dono = %s, lease_ate = NOW() + make_interval(secs => %s) "
+                "WHERE nome = %s AND (ultima_execucao IS NULL OR ultima_execucao < %s) "
+                "AND (lease_ate IS NULL OR lease_ate < NOW() OR dono = %s) "
+                "RETURNING nome",
+                (INSTANCIA_ID, AGENDA_LEASE, nome, ocorrencia, INSTANCIA_ID)
+            )
+            if c.fetchone():
+                conn.commit()
+                return "ok"
+            c.execute("SELECT ultima_execucao FROM agendamentos WHERE nome = %s", (nome,))
+            row = c.fetchone()
+        if row and row[0] is not None and row[0] >= ocorrencia:
+            return "feita"
+        return "ocupada"
+
+    def _liberar(self, nome):
+        with conexao() as conn:
+            c = conn.cursor()
+            c.execute("UPDATE agendamentos SET dono = NULL, lease_ate = NULL WHERE nome = %s AND dono = %s", (nome, INSTANCIA_ID))
+            conn.commit()
+
+    async def iniciar(self, app):
+        self.bot = app.bot
+        agora = datetime.now()
+        ultimas = await run_db(self._ler_execucoes)
+        for t in self.tarefas.values():
+            if t.intervalo:
+                t.proxima = t.ocorrencia = t.proxima_apos(agora)
+                continue
+            anterior = t.anterior_a(agora)
+            ultima = ultimas.get(t.nome)
+            t.ultima_execucao = ultima
+            if t.persistente and ultima is None:
+                # Primeira vez: começa a contar daqui, sem disparar retroativo
+                await run_db(self._gravar_execucao, t.nome, anterior)
+            elif t.persistente and ultima < anterior:
+                logger.info(f"⏰ Recuperando '{t.nome}' perdida em {anterior:%d/%m %H:%M}")
+                t.proxima, t.ocorrencia = agora, anterior
+                continue
+            t.ocorrencia = t.proxima_apos(agora)
+            t.proxima = t.ocorrencia
+        self._task = asyncio.create_task(self._loop())
+
+    async def parar(self, app=None):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    async def _executar(self, t):
+        ocorrencia = t.ocorrencia
+        if t.persistente:
+            try:
+                reserva = await run_db(self._reservar, t.nome, ocorrencia)
+            except Exception as e:
+                logger.error(f"Erro ao reservar a tarefa '{t.nome}': {e}")
+                reserva = "ocupada"
+            if reserva == "ocupada":
+                # Outra réplica está rodando: confere de novo depois (assume se o lease vencer)
+                t.proxima = datetime.now() + timedelta(seconds=self.RETRY)
+                return
+            if reserva == "feita":
+                t.puladas += 1
+                t.ocorrencia = t.proxima = t.proxima_apos(max(ocorrencia, datetime.now()))
+                return
+        inicio = time.monotonic()
+        try:
+            await t.func(ocorrencia)
+            if t.persistente:
+                await run_db(self._gravar_execucao, t.nome, ocorrencia)
+        except Exception as e:
+            t.falhas += 1
+            t.ultimo_erro = f"{datetime.now():%d/%m %H:%M} {e}"
+            logger.error(f"Erro na tarefa agendada '{t.nome}': {e}")
+            if t.persistente:
                 try:
-                    context.bot.send_message(admin_id, texto, parse_mode='HTML')
-                except Exception as e:
-                    logger.error(f"Falha ao enviar ranking para admin {admin_id}: {e}")
+                    await run_db(self._liberar, t.nome)
+                except Exception:
+                    pass
+                # Tenta de novo a mesma ocorrência em instantes
+                t.proxima = datetime.now() + timedelta(seconds=self.RETRY)
+                return
+        finally:
+            duracao = time.monotonic() - inicio
+            t.execucoes += 1
+            t.duracao_total += duracao
+            t.duracao_max = max(t.duracao_max, duracao)
+            t.ultima_execucao = datetime.now()
+        t.ocorrencia = t.proxima_apos(datetime.now() if t.intervalo else ocorrencia)
+        if t.ocorrencia <= datetime.now():
+            # Ficou mais de um ciclo parada: pula para a próxima futura
+            t.ocorrencia = t.proxima_apos(datetime.now())
+        t.proxima = t.ocorrencia
+
+    async def _loop(self):
+        while True:
+            agora = datetime.now()
+            for t in sorted(self.tarefas.values(), key=lambda t: t.proxima):
+                if t.proxima <= agora:
+                    await self._executar(t)
+            espera = (min(t.proxima for t in self.tarefas.values()) - datetime.now()).total_seconds()
+            # Acorda pelo menos a cada minuto para acompanhar ajustes de relógio
+            await asyncio.sleep(min(max(espera, 0.5), 60))
+
+    def stats(self):
+        return sorted(self.tarefas.values(), key=lambda t: t.proxima or datetime.max)
+
+async def limpar_pendencias(ocorrencia):
+    # A parte em memória roda direto no event loop, junto dos handlers que usam PENDENCIAS
+    PENDENCIAS.purgar()
+    if PENDENCIAS.persistente:
+        await run_db(PENDENCIAS.purgar_banco)
+
+AGENDADOR = Agendador()
+AGENDADOR.semanal("ranking_semanal", 0, (6, 0), ranking_semanal)
+AGENDADOR.diaria("manter_particoes", (5, 0), lambda oc: run_db(manter_particoes))
+AGENDADOR.a_cada("limpar_pendencias", 60, limpar_pendencias)
+AGENDADOR.a_cada("sincronizar_caches", CACHE_SYNC_INTERVAL, lambda oc: run_db(sincronizar_caches))
+AGENDADOR.a_cada("flush_last_seen", LAST_SEEN_FLUSH_INTERVAL, lambda oc: run_db(flush_last_seen))
+if LIMITES.compartilhado:
+    AGENDADOR.a_cada("limpar_limites", 3600, lambda oc: run_db(LIMITES.limpar_banco))
+
+class RodaTimeouts:
+    """Timeouts de conversa (ex.: /editarficha) numa roda de tempo com hash, no event loop.
+
+    Cada casa cobre 'resolucao' segundos e guarda um dict chave -> [voltas, callback];
+    armar e cancelar são O(1) e uma única task gira a roda, no lugar de uma
+    thread dormindo por timeout.
+    """
+
+    def __init__(self, casas=512, resolucao=1.0):
+        self.casas = [{} for _ in range(casas)]
+        self.resolucao = resolucao
+        self._onde = {}  # chave -> índice da casa
+        self._posicao = 0
+        self._task = None
+        self.disparados = 0
+        self.cancelados = 0
+
+    def agendar(self, chave, segundos, callback):
+        """Arma (ou rearma) o timeout 'chave'. callback não recebe argumentos e pode ser async."""
+        self.cancelar(chave, contar=False)
+        passos = max(1, math.ceil(segundos / self.resolucao))
+        casa = (self._posicao + passos) % len(self.casas)
+        self.casas[casa][chave] = [(passos - 1) // len(self.casas), callback]
+        self._onde[chave] = casa
+
+    def cancelar(self, chave, contar=True):
+        casa = self._onde.pop(chave, None)
+        if casa is None:
+            return False
+        del self.casas[casa][chave]
+        if contar:
+            self.cancelados += 1
+        return True
 
-        c.execute("DELETE FROM xp_semana WHERE semana_inicio=%s", (semana,))
-        conn.commit()
-    finally:
-        if conn:
-            put_conn(conn)
-
-def thread_reset_xp():
-    while True:
-        now = datetime.now()
-        proxima = now.replace(hour=6, minute=0, second=0, microsecond=0)
-        while proxima.weekday() != 0:
-            proxima += timedelta(days=1)
-        if now >= proxima:
-            proxima += timedelta(days=7)
-        wait = (proxima - now).total_seconds()
-        time.sleep(wait)
-        ranking_semanal()
+    def _avancar(self):
+        self._posicao = (self._posicao + 1) % len(self.casas)
+        casa = self.casas[self._posicao]
+        vencidos = []
+        for chave, entrada in list(casa.items()):
+            if entrada[0] > 0:
+                entrada[0] -= 1  # ainda faltam voltas completas
+                continue
+            del casa[chave]
+            del self._onde[chave]
+            vencidos.append((chave, entrada[1]))
+        for chave, callback in vencidos:
+            self.disparados += 1
+            try:
+                resultado = callback()
+                if asyncio.iscoroutine(resultado):
+                    asyncio.create_task(self._aguardar(chave, resultado))
+            except Exception as e:
+                logger.error(f"Erro no timeout {chave}: {e}")
+
+    async def _aguardar(self, chave, coro):
+        try:
+            await coro
+        except Exception as e:
+            logger.error(f"Erro no timeout {chave}: {e}")
+
+    async def _girar(self):
+        loop = asyncio.get_running_loop()
+        proximo = loop.time()
+        while True:
+            proximo += self.resolucao
+            # Se o loop atrasou, os passos atrasados rodam em seguida, sem pular casas
+            await asyncio.sleep(max(0, proximo - loop.time()))
+            self._avancar()
+
+    def iniciar(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._girar())
+
+    def parar(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    def stats(self):
+        return {"ativos": len(self._onde), "disparados": self.disparados, "cancelados": self.cancelados,
+                "casas": len(self.casas), "resolucao": self.resolucao}
+
+TIMEOUTS = RodaTimeouts()
+
+async def ao_iniciar(app):
+    await AGENDADOR.iniciar(app)
+    TIMEOUTS.iniciar()
+    # Edições de ficha abertas antes do reinício voltaram com PENDENCIAS.carregar(); rearma o timeout delas
+    agora = time.time()
+    for chave, expira in PENDENCIAS.ativas("edicao"):
+        armar_timeout_edicao(int(chave), expira - agora)
+
+async def ao_encerrar(app):
+    TIMEOUTS.parar()
+    await AGENDADOR.parar(app)
 
 # ================== COMANDOS ==================
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not anti_spam(update.effective_user.id):
+    if not await anti_spam(update, "start"):
         await update.message.reply_text("⏳ Ei! Espere um instante antes de usar outro comando.")
         return
     uid = update.effective_user.id
     nome = update.effective_user.first_name
     username = update.effective_user.username
-    if not get_player(uid):
-        create_player(uid, nome, username)
-        register_username(uid, username, nome)
-        update_player_field(uid, 'hp_max', 40)
-        update_player_field(uid, 'sp_max', 40)
+    if not await run_db(get_player, uid):
+        await run_db(create_player, uid, nome, username)
+        await run_db(register_username, uid, username, nome)
+        await run_db(update_player_field, uid, 'hp_max', 40)
+        await run_db(update_player_field, uid, 'sp_max', 40)
     await update.message.reply_text(
     f"\u200B\n 𐚁  𝗕𝗼𝗮𝘀 𝘃𝗶𝗻𝗱𝗮𝘀, {nome} ! \n\n"
     "Este bot gerencia seus Dados, Ficha, Inventário, Vida e Sanidade, além de diversos outros sistemas que você poderá explorar.\n\n"
@@ -992,11 +2506,11 @@ async def liberar(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Uso: /liberar @jogador")
         return
     target_tag = context.args[0]
-    target_id = username_to_id(target_tag)
+    target_id = await run_db(username_to_id, target_tag)
     if not target_id:
         await update.message.reply_text("❌ Jogador não encontrado.")
         return
-    liberar_usuario(target_id)
+    await run_db(liberar_usuario, target_id)
     await update.message.reply_text(f"✅ Jogador {target_tag} liberado para usar o bot.")
 
 async def desliberar(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1008,11 +2522,11 @@ async def desliberar(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Uso: /desliberar @jogador")
         return
     target_tag = context.args[0]
-    target_id = username_to_id(target_tag)
+    target_id = await run_db(username_to_id, target_tag)
     if not target_id:
         await update.message.reply_text("❌ Jogador não encontrado.")
         return
-    desliberar_usuario(target_id)
+    await run_db(desliberar_usuario, target_id)
     await update.message.reply_text(f"❌ Jogador {target_tag} removido da lista de liberados.")
 
 async def turno(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1032,115 +2546,65 @@ async def turno(update: Update, context: ContextTypes.DEFAULT_TYPE):
     texto_limpo = re.sub(r'^/turno(?:@\w+)?', '', texto, flags=re.IGNORECASE).strip()
     caracteres = len(texto_limpo)
 
-    conn = None
-    try:
-        conn = get_conn()
-        c = conn.cursor()
-
-        c.execute("SELECT 1 FROM turnos WHERE player_id=%s AND data=%s", (uid, hoje))
-        if c.fetchone():
-            await update.message.reply_text("Você já enviou seu turno hoje! Apenas 1 por dia é contabilizado.")
-            return
-
-        if not texto_limpo:
-            await update.message.reply_text(
-                "ℹ️ Para registrar um turno, use este comando seguido do seu texto.\n\n"
-                "Exemplo:\n"
-                "<code>/turno O personagem caminhou pela floresta, descrevendo as árvores geladas...</code>\n\n"
-                "⚠️ O texto precisa ter no mínimo 499 caracteres para ser contabilizado.",
-                parse_mode="HTML"
-            )
-            return
-
-        if caracteres < 499:
-            await update.message.reply_text(
-                f"⚠️ Seu turno precisa ter pelo menos 499 caracteres! (Atualmente: {caracteres})\n"
-                "Nada foi registrado. Envie novamente com mais conteúdo."
-            )
-            return
-
-        mencoes = set(re.findall(r"@(\w+)", texto_limpo))
-        if username:
-            mencoes.discard(username.lower())
-        mencoes = list(mencoes)
-        if len(mencoes) > 5:
-            mencoes = mencoes[:5]
-            await update.message.reply_text("⚠️ Só é possível mencionar até 5 jogadores por turno. Apenas os 5 primeiros serão considerados.")
-        mencoes_str = ",".join(mencoes) if mencoes else ""
-
-        xp = xp_por_caracteres(caracteres)
-
-        c.execute("SELECT data FROM turnos WHERE player_id=%s AND data >= %s ORDER BY data", (uid, semana))
-        dias = [row[0] for row in c.fetchall()]
-        streak_atual = 1
-        if dias:
-            prev = dias[-1]
-            if (hoje - prev).days == 1:
-                streak_atual = len(dias) + 1
-            else:
-                streak_atual = 1
-
-        bonus_streak = 0
-        if streak_atual == 3:
-            bonus_streak = 5
-        elif streak_atual == 5:
-            bonus_streak = 10
-        elif streak_atual == 7:
-            bonus_streak = 20
-
-        xp_dia = min(xp + bonus_streak, 25)
+    if await run_db(turno_ja_registrado, uid, hoje):
+        await update.message.reply_text("Você já enviou seu turno hoje! Apenas 1 por dia é contabilizado.")
+        return
 
-        c.execute(
-            "INSERT INTO turnos (player_id, data, caracteres, mencoes) VALUES (%s, %s, %s, %s)",
-            (uid, hoje, caracteres, mencoes_str)
+    if not texto_limpo:
+        await update.message.reply_text(
+            "ℹ️ Para registrar um turno, use este comando seguido do seu texto.\n\n"
+            "Exemplo:\n"
+            "<code>/turno O personagem caminhou pela floresta, descrevendo as árvores geladas...</code>\n\n"
+            "⚠️ O texto precisa ter no mínimo 499 caracteres para ser contabilizado.",
+            parse_mode="HTML"
         )
-        c.execute(
-            "INSERT INTO xp_semana (player_id, semana_inicio, xp_total, streak_atual) VALUES (%s, %s, %s, %s) "
-            "ON CONFLICT (player_id, semana_inicio) DO UPDATE SET xp_total = xp_semana.xp_total + %s, streak_atual = %s",
-            (uid, semana, xp_dia, streak_atual, xp_dia, streak_atual)
+        return
+
+    if caracteres < 499:
+        await update.message.reply_text(
+            f"⚠️ Seu turno precisa ter pelo menos 499 caracteres! (Atualmente: {caracteres})\n"
+            "Nada foi registrado. Envie novamente com mais conteúdo."
         )
+        return
 
-        interacoes_bonificadas = set()
-        for mencionado in mencoes:
-            mencionado_id = username_to_id(f"@{mencionado}")
-            if mencionado_id and mencionado_id != uid:
-                c.execute("SELECT mencoes FROM turnos WHERE player_id=%s AND data=%s", (mencionado_id, hoje))
-                row = c.fetchone()
-                if row and row[0]:
-                    mencoes_do_outra_pessoa = set(row[0].split(","))
-                    if username and username.lower() in mencoes_do_outra_pessoa:
-                        par = tuple(sorted([uid, mencionado_id]))
-                        if par not in interacoes_bonificadas:
-                            c.execute("UPDATE xp_semana SET xp_total = xp_total + 5 WHERE player_id=%s AND semana_inicio=%s", (uid, semana))
-                            c.execute("UPDATE xp_semana SET xp_total = xp_total + 5 WHERE player_id=%s AND semana_inicio=%s", (mencionado_id, semana))
-                            interacoes_bonificadas.add(par)
-                            try:
-                                await context.bot.send_message(uid, f"🎉 Você e @{mencionado} mencionaram um ao outro no turno de hoje! Ambos ganharam +5 XP de interação mútua.", parse_mode="HTML")
-                                await context.bot.send_message(mencionado_id, f"🎉 Você e @{username} mencionaram um ao outro no turno de hoje! Ambos ganharam +5 XP de interação mútua.", parse_mode="HTML")
-                            except Exception as e:
-                                logger.warning(f"Falha ao enviar mensagem privada de bônus: {e}")
+    mencoes = set(re.findall(r"@(\w+)", texto_limpo))
+    if username:
+        mencoes.discard(username.lower())
+    mencoes = list(mencoes)
+    if len(mencoes) > 5:
+        mencoes = mencoes[:5]
+        await update.message.reply_text("⚠️ Só é possível mencionar até 5 jogadores por turno. Apenas os 5 primeiros serão considerados.")
+
+    xp = xp_por_caracteres(caracteres)
+    registro = await run_db(registrar_turno, uid, username, hoje, semana, caracteres, mencoes)
+    if registro is None:
+        await update.message.reply_text("Você já enviou seu turno hoje! Apenas 1 por dia é contabilizado.")
+        return
+    streak_atual, bonus_streak, bonificados = registro
 
-        conn.commit()
+    for mencionado, mencionado_id in bonificados:
+        try:
+            await context.bot.send_message(uid, f"🎉 Você e @{mencionado} mencionaram um ao outro no turno de hoje! Ambos ganharam +5 XP de interação mútua.", parse_mode="HTML")
+            await context.bot.send_message(mencionado_id, f"🎉 Você e @{username} mencionaram um ao outro no turno de hoje! Ambos ganharam +5 XP de interação mútua.", parse_mode="HTML")
+        except Exception as e:
+            logger.warning(f"Falha ao enviar mensagem privada de bônus: {e}")
 
-        msg = f"Turno registrado!\nCaracteres: {caracteres}\nXP ganho hoje: {xp}"
-        if bonus_streak:
-            msg += f"\nBônus de streak: +{bonus_streak} XP"
-        msg += f"\nStreak atual: {streak_atual} dias"
-        await update.message.reply_text(msg)
-    finally:
-        if conn:
-            put_conn(conn)
+    msg = f"Turno registrado!\nCaracteres: {caracteres}\nXP ganho hoje: {xp}"
+    if bonus_streak:
+        msg += f"\nBônus de streak: +{bonus_streak} XP"
+    msg += f"\nStreak atual: {streak_atual} dias"
+    await update.message.reply_text(msg)
 
 async def ficha(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_liberado(update.effective_user.id):
         await acesso_negado(update)
         return
-    if not anti_spam(update.effective_user.id):
+    if not await anti_spam(update, "ficha"):
         await update.message.reply_text("⏳ Ei! Espere um instante antes de usar outro comando.")
         return
     uid = update.effective_user.id
-    register_username(uid, update.effective_user.username, update.effective_user.first_name)
-    player = get_player(uid)
+    await registrar_usuario(uid, update.effective_user.username, update.effective_user.first_name)
+    player = await run_db(get_player, uid)
     if not player:
         await update.message.reply_text("Você precisa usar /start primeiro!")
         return
@@ -1166,29 +2630,19 @@ async def editarficha(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_liberado(update.effective_user.id):
         await acesso_negado(update)
         return
-    if not anti_spam(update.effective_user.id):
+    if not await anti_spam(update, "editarficha"):
         await update.message.reply_text("⏳ Ei! Espere um instante antes de usar outro comando.")
         return
 
     uid = update.effective_user.id
-    player = get_player(uid)
+    player = await run_db(get_player, uid)
     if not player:
         await update.message.reply_text("Use /start primeiro!")
         return
 
-    EDIT_PENDING[uid] = True
-    
-    if uid in EDIT_TIMERS:
-        EDIT_TIMERS[uid].cancel()
-    
-    def timeout_edit():
-        EDIT_PENDING.pop(uid, None)
-        EDIT_TIMERS.pop(uid, None)
-        logger.info(f"Timeout de edição para usuário {uid}")
-    
-    EDIT_TIMERS[uid] = threading.Timer(300.0, timeout_edit)
-    EDIT_TIMERS[uid].start()
-    
+    await PENDENCIAS.guardar("edicao", uid, True)
+    armar_timeout_edicao(uid, PENDENCIA_TTL)
+
     campos_ficha = ""
     for a in ATRIBUTOS_LISTA:
         campos_ficha += f"{a}: \n"
@@ -1207,19 +2661,25 @@ async def editarficha(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     await update.message.reply_text(text, parse_mode="HTML")
 
+def armar_timeout_edicao(uid, segundos):
+    async def timeout_edit():
+        await PENDENCIAS.retirar("edicao", uid)
+        logger.info(f"Timeout de edição para usuário {uid}")
+
+    TIMEOUTS.agendar(("edicao", uid), segundos, timeout_edit)
+
 async def receber_edicao(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
-    if uid not in EDIT_PENDING:
+    if not PENDENCIAS.contem("edicao", uid):
         return
 
-    player = get_player(uid)
+    player = await run_db(get_player, uid)
     if not player:
         await update.message.reply_text("Use /start primeiro!")
         return
 
     text = update.message.text
-    EDIT_TEMP = player["atributos"].copy()
-    EDIT_TEMP.update(player["pericias"])
+    edicao = EdicaoFicha(player)
 
     linhas = text.split("\n")
     for linha in linhas:
@@ -1238,63 +2698,36 @@ async def receber_edicao(update: Update, context: ContextTypes.DEFAULT_TYPE):
             if val < 1 or val > 6:
                 await update.message.reply_text("❌ Formato inválido! Atributos devem estar entre 1 e 6.")
                 return
-            soma_atributos = sum(EDIT_TEMP.get(a, 0) for a in ATRIBUTOS_LISTA if a != key_real) + val
+            soma_atributos = sum(edicao.valor(a) for a in ATRIBUTOS_LISTA if a != key_real) + val
             if soma_atributos > MAX_ATRIBUTOS:
                 await update.message.reply_text("❌ Total de pontos em atributos excede 20.")
                 return
-            EDIT_TEMP[key_real] = val
+            edicao.alterar(key_real, val)
 
         elif key in PERICIAS_NORMAL:
             key_real = PERICIAS_NORMAL[key]
             if val < 1 or val > 6:
                 await update.message.reply_text("❌ Formato inválido! Perícias devem estar entre 1 e 6.")
                 return
-            soma_pericias = sum(EDIT_TEMP.get(p, 0) for p in PERICIAS_LISTA if p != key_real) + val
+            soma_pericias = sum(edicao.valor(p) for p in PERICIAS_LISTA if p != key_real) + val
             if soma_pericias > MAX_PERICIAS:
                 await update.message.reply_text("❌ Total de pontos em perícias excede 40.")
                 return
-            EDIT_TEMP[key_real] = val
+            edicao.alterar(key_real, val)
 
         else:
             await update.message.reply_text(f"❌ Campo não reconhecido: {key}")
             return
 
-    player["atributos"] = {k: EDIT_TEMP[k] for k in ATRIBUTOS_LISTA}
-    player["pericias"] = {k: EDIT_TEMP[k] for k in PERICIAS_LISTA}
-
-    for atr in ATRIBUTOS_LISTA:
-        update_atributo(uid, atr, player["atributos"][atr])
-    for per in PERICIAS_LISTA:
-        update_pericia(uid, per, player["pericias"][per])
-    ensure_peso_max_by_forca(uid)
-
-    vit = player["atributos"].get("Vitalidade", 0)
-    eq = player["atributos"].get("Equilíbrio", 0)
-    hp_max = vitalidade_para_hp(vit)
-    sp_max = equilibrio_para_sp(eq)
-    update_player_field(uid, "hp_max", hp_max)
-    update_player_field(uid, "sp_max", sp_max)
-
-    if player["hp"] == 0 or player["hp"] > hp_max:
-        update_player_field(uid, "hp", hp_max)
-    else:
-        update_player_field(uid, "hp", min(player["hp"], hp_max))
-    if player["sp"] == 0 or player["sp"] > sp_max:
-        update_player_field(uid, "sp", sp_max)
-    else:
-        update_player_field(uid, "sp", min(player["sp"], sp_max))
-
-    atualizar_necessidades_por_tempo(uid)
+    await run_db(edicao.gravar)
 
     await update.message.reply_text(" ✅ Ficha atualizada com sucesso!")
     
-    EDIT_PENDING.pop(uid, None)
-    if uid in EDIT_TIMERS:
-        EDIT_TIMERS[uid].cancel()
-        EDIT_TIMERS.pop(uid, None)
+    await PENDENCIAS.retirar("edicao", uid)
+    TIMEOUTS.cancelar(("edicao", uid))
     
 async def verficha(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not anti_spam(update.effective_user.id):
+    if not await anti_spam(update, "verficha"):
         await update.message.reply_text("⏳ Ei! Espere um instante antes de usar outro comando.")
         return
     
@@ -1309,12 +2742,12 @@ async def verficha(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     user_tag = context.args[0]
-    target_id = username_to_id(user_tag)
+    target_id = await run_db(username_to_id, user_tag)
     if not target_id:
         await update.message.reply_text("❌ Jogador não encontrado. Peça para a pessoa usar /start pelo menos uma vez.")
         return
     
-    player = get_player(target_id)
+    player = await run_db(get_player, target_id)
     if not player:
         await update.message.reply_text("❌ Jogador não encontrado no sistema.")
         return
@@ -1335,20 +2768,95 @@ async def verficha(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text += f"\n📊 <b>Info Admin:</b>\n"
     text += f" — ID: {player['id']}\n"
     text += f" — Username: @{player['username'] or 'N/A'}\n"
-    text += f" — Rerolls: {player['rerolls']}/3\n\u200B"
+    text += f" — Rerolls: {player['rerolls']}/{REROLLS_DIARIOS}\n\u200B"
     
     await update.message.reply_text(text, parse_mode="HTML")
 
+async def metricas(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    uid = update.effective_user.id
+    if not is_admin(uid):
+        await update.message.reply_text("❌ Apenas administradores podem usar este comando.")
+        return
+    cache = PLAYER_CACHE.stats()
+    cache_usernames = USERNAME_CACHE.stats()
+    catalogo = CATALOGO.stats()
+    liberados = LIBERADOS.stats()
+    placar = PLACAR.stats()
+    pendencias = PENDENCIAS.stats()
+    timeouts = TIMEOUTS.stats()
+    limites = LIMITES.stats()
+    db = pool_stats()
+    lines = [
+        "📊 <b>Métricas do bot</b>",
+        "",
+        "<b>Cache de jogadores</b>",
+        f" — Itens: {cache['tamanho']}/{cache['max']}",
+        f" — Hits: {cache['hits']} | Misses: {cache['misses']} ({cache['hit_rate']:.0%})",
+        f" — Despejos: {cache['evictions']} | Expirados: {cache['expirations']}",
+        "",
+        "<b>Cache de usernames</b>",
+        f" — Itens: {cache_usernames['tamanho']}/{cache_usernames['max']}",
+        f" — Hits: {cache_usernames['hits']} | Misses: {cache_usernames['misses']} ({cache_usernames['hit_rate']:.0%})",
+        "",
+        "<b>Cópias em memória</b>",
+        f" — Catálogo: {catalogo['itens']} itens | Versão: {catalogo['versao']} | Recargas: {catalogo['recargas']}",
+        f" — Liberados: {liberados['ids']} | Versão: {liberados['versao']} | Recargas: {liberados['recargas']}",
+        f" — Ranking: {placar['jogadores']} jogadores | Semana: {placar['semana']} | Versão: {placar['versao']} | Recargas: {placar['recargas']}",
+        "",
+        "<b>Confirmações pendentes</b>",
+        f" — Ativas: {pendencias['ativas']} ({', '.join(f'{ns}: {n}' for ns, n in sorted(pendencias['por_tipo'].items())) or 'nenhuma'})",
+        f" — Expiradas: {pendencias['expiradas']} | Heap: {pendencias['heap']} | Banco: {'sim' if pendencias['persistente'] else 'não'}",
+        "",
+        "<b>Timeouts de conversa</b>",
+        f" — Ativos: {timeouts['ativos']} | Disparados: {timeouts['disparados']} | Cancelados: {timeouts['cancelados']}",
+        f" — Roda: {timeouts['casas']} casas de {timeouts['resolucao']:g} s",
+        "",
+        "<b>Pool de conexões</b>",
+        f" — Em uso: {db['em_uso']}/{db['max']} (pico {db['pico_em_uso']})",
+        f" — Checkouts: {db['checkouts']} | Espera média: {db['espera_media'] * 1000:.1f} ms (máx {db['espera_max'] * 1000:.0f} ms)",
+        f" — Validações: {db['validacoes']} | Reconexões: {db['reconexoes']} | Aberturas: {db['aberturas']} | Esgotamentos: {db['esgotamentos']}",
+        "",
+        "<b>Limite de comandos</b>",
+        f" — Aceitos: {limites['aceitos']} | Recusados: {sum(sum(n.values()) for n in limites['recusas'].values())}",
+        f" — Baldes: {limites['baldes']}/{limites['max']} (despejos {limites['despejos']}) | "
+        f"Banco: {'sim' if limites['compartilhado'] else 'não'} (falhas {limites['falhas_banco']})",
+    ]
+    recusas = sorted(limites["recusas"].items(), key=lambda kv: -sum(kv[1].values()))
+    for comando, por_escopo in recusas[:5]:
+        detalhe = ", ".join(f"{escopo} {n}" for escopo, n in sorted(por_escopo.items()))
+        lines.append(f" — /{comando}: {sum(por_escopo.values())} recusas ({detalhe})")
+    await update.message.reply_text("\n".join(lines), parse_mode="HTML")
+
+async def agenda(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    uid = update.effective_user.id
+    if not is_admin(uid):
+        await update.message.reply_text("❌ Apenas administradores podem usar este comando.")
+        return
+    lines = ["⏰ <b>Tarefas agendadas</b>", f"Instância: <code>{INSTANCIA_ID}</code>", ""]
+    for t in AGENDADOR.stats():
+        media = (t.duracao_total / t.execucoes) if t.execucoes else 0.0
+        proxima = f"{t.proxima:%d/%m %H:%M:%S}" if t.proxima else "—"
+        ultima = f"{t.ultima_execucao:%d/%m %H:%M}" if t.ultima_execucao else "nunca"
+        lines.append(f"<b>{t.nome}</b>")
+        lines.append(f" — Próxima: {proxima} | Última: {ultima}")
+        lines.append(
+            f" — Execuções: {t.execucoes} | Falhas: {t.falhas} | Por outra réplica: {t.puladas} | "
+            f"Duração média: {media * 1000:.0f} ms (máx {t.duracao_max * 1000:.0f} ms)"
+        )
+        if t.ultimo_erro:
+            lines.append(f" — Último erro: {t.ultimo_erro}")
+    await update.message.reply_text("\n".join(lines), parse_mode="HTML")
+
 async def inventario(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_liberado(update.effective_user.id):
         await acesso_negado(update)
         return
-    if not anti_spam(update.effective_user.id):
+    if not await anti_spam(update, "inventario"):
         await update.message.reply_text("⏳ Ei! Espere um instante antes de usar outro comando.")
         return
     uid = update.effective_user.id
-    register_username(uid, update.effective_user.username, update.effective_user.first_name)
-    player = get_player(uid)
+    await registrar_usuario(uid, update.effective_user.username, update.effective_user.first_name)
+    player = await run_db(get_player, uid)
     if not player:
         await update.message.reply_text("Use /start primeiro!")
         return
@@ -1375,7 +2883,7 @@ async def itens(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_liberado(update.effective_user.id):
         await acesso_negado(update)
         return
-    if not anti_spam(update.effective_user.id):
+    if not await anti_spam(update, "itens"):
         await update.message.reply_text("⏳ Ei! Espere um instante antes de usar outro comando.")
         return
     try:
@@ -1408,7 +2916,7 @@ async def itens(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("\n".join(lines))
 
 async def additem(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not anti_spam(update.effective_user.id):
+    if not await anti_spam(update, "additem"):
         await update.message.reply_text("⏳ Ei! Espere um instante antes de usar outro comando.")
         return
     uid = update.effective_user.id
@@ -1425,13 +2933,13 @@ async def additem(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ Peso inválido. Use algo como 2,5")
         return
     try:
-        add_catalog_item(nome, peso)
+        await run_db(add_catalog_item, nome, peso)
         await update.message.reply_text(f"✅ Item '{nome}' adicionado ao catálogo com {peso:.2f} kg.")
     except Exception as e:
         await update.message.reply_text("Erro ao adicionar item ao catálogo. Tente novamente.")
     
 async def addconsumivel(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not anti_spam(update.effective_user.id):
+    if not await anti_spam(update, "addconsumivel"):
         await update.message.reply_text("⏳ Ei! Espere um instante antes de usar outro comando.")
         return
     uid = update.effective_user.id
@@ -1465,30 +2973,15 @@ async def addconsumivel(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if len(args) > peso_idx + 2:
             armas_compat = " ".join(args[peso_idx + 2:])
 
-    conn = None
-    try:
-        conn = get_conn()
-        c = conn.cursor()
-        c.execute('''INSERT INTO pending_consumivel (user_id, nome, peso, bonus, armas_compat)
-                     VALUES (%s, %s, %s, %s, %s)
-                     ON CONFLICT (user_id) DO UPDATE SET nome=%s, peso=%s, bonus=%s, armas_compat=%s, created_at=NOW()''',
-                  (uid, nome, peso, bonus, armas_compat, nome, peso, bonus, armas_compat))
-        conn.commit()
-    finally:
-        if conn:
-            put_conn(conn)
-            await update.message.reply_text(
-                "Esse item consumível é de cura, dano, munição, comida, bebida ou nenhum?\nResponda: cura/dano/municao/comida/bebida/nenhum"
-            )
+    await run_db(set_pending_consumivel, uid, nome, peso, bonus, armas_compat)
+    await update.message.reply_text(
+        "Esse item consumível é de cura, dano, munição, comida, bebida ou nenhum?\nResponda: cura/dano/municao/comida/bebida/nenhum"
+    )
 
 async def receber_tipo_consumivel(update: Update, context: ContextTypes.DEFAULT_TYPE, row=None):
     uid = update.effective_user.id
     if row is None:
-        conn = get_conn()
-        c = conn.cursor()
-        c.execute("SELECT nome, peso, bonus, armas_compat FROM pending_consumivel WHERE user_id=%s", (uid,))
-        row = c.fetchone()
-        put_conn(conn)
+        row = await run_db(get_pending_consumivel, uid)
         if not row:
             return
             
@@ -1517,12 +3010,8 @@ async def receber_tipo_consumivel(update: Update, context: ContextTypes.DEFAULT_
         return
         
     try:
-        add_catalog_item(nome, peso, consumivel=True, bonus=bonus, tipo=tipo, armas_compat=armas_compat)
-        conn = get_conn()
-        c = conn.cursor()
-        c.execute("DELETE FROM pending_consumivel WHERE user_id=%s", (uid,))
-        conn.commit()
-        put_conn(conn)
+        await run_db(add_catalog_item, nome, peso, consumivel=True, bonus=bonus, tipo=tipo, armas_compat=armas_compat)
+        await run_db(del_pending_consumivel, uid)
         await update.message.reply_text(f"✅ Consumível '{nome}' adicionado ao catálogo com {peso:.2f} kg. Bônus: {bonus}, Tipo: {tipo}.")
     except Exception as e:
         logger.error(f"Erro ao adicionar consumível: {e}")
@@ -1530,7 +3019,7 @@ async def receber_tipo_consumivel(update: Update, context: ContextTypes.DEFAULT_
 
 async def texto_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
-    if uid in EDIT_PENDING:
+    if PENDENCIAS.contem("edicao", uid):
         await receber_edicao(update, context)
         return
     if 'pending_tipo_consumivel' in context.user_data:
@@ -1541,30 +3030,22 @@ async def texto_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("Digite apenas o número.")
             return
         if tipo == "comida":
-            add_catalog_item(nome, peso, consumivel=True, bonus=bonus, tipo=tipo, armas_compat=armas_compat, rest_hunger=valor)
+            await run_db(add_catalog_item, nome, peso, consumivel=True, bonus=bonus, tipo=tipo, armas_compat=armas_compat, rest_hunger=valor)
             await update.message.reply_text(f"Consumível '{nome}' adicionado ao catálogo. Reduz {valor} de fome.")
         elif tipo == "bebida":
-            add_catalog_item(nome, peso, consumivel=True, bonus=bonus, tipo=tipo, armas_compat=armas_compat, rest_thirst=valor)
+            await run_db(add_catalog_item, nome, peso, consumivel=True, bonus=bonus, tipo=tipo, armas_compat=armas_compat, rest_thirst=valor)
             await update.message.reply_text(f"Consumível '{nome}' adicionado ao catálogo. Reduz {valor} de sede.")
         del context.user_data['pending_tipo_consumivel']
-        conn = get_conn()
-        c = conn.cursor()
-        c.execute("DELETE FROM pending_consumivel WHERE user_id=%s", (uid,))
-        conn.commit()
-        put_conn(conn)
+        await run_db(del_pending_consumivel, uid)
         return
 
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute("SELECT nome, peso, bonus, armas_compat FROM pending_consumivel WHERE user_id=%s", (uid,))
-    row = c.fetchone()
-    put_conn(conn)
+    row = await run_db(get_pending_consumivel, uid)
     if row:
         await receber_tipo_consumivel(update, context, row=row)
         return
 
 async def addarma(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not anti_spam(update.effective_user.id):
+    if not await anti_spam(update, "addarma"):
         await update.message.reply_text("⏳ Ei! Espere um instante antes de usar outro comando.")
         return
     uid = update.effective_user.id
@@ -1608,7 +3089,7 @@ async def addarma(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
         
     try:
-        add_catalog_item(
+        await run_db(add_catalog_item, 
             nome, peso, consumivel=False, bonus='0', tipo='', arma_tipo=arma_tipo,
             arma_bonus=arma_bonus, muni_atual=muni_atual, muni_max=muni_max
         )
@@ -1621,7 +3102,7 @@ async def addarma(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(f"Erro ao adicionar arma ao catálogo. Detalhe: {e}")
 
 async def delitem(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not anti_spam(update.effective_user.id):
+    if not await anti_spam(update, "delitem"):
         await update.message.reply_text("⏳ Ei! Espere um instante antes de usar outro comando.")
         return
     uid = update.effective_user.id
@@ -1632,7 +3113,7 @@ async def delitem(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Uso: /delitem NomeDoItem")
         return
     nome = " ".join(context.args)
-    ok = del_catalog_item(nome)
+    ok = await run_db(del_catalog_item, nome)
     if ok:
         await update.message.reply_text(f"🗑️ Item '{nome}' removido do catálogo.")
     else:
@@ -1643,7 +3124,7 @@ async def dar(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_liberado(update.effective_user.id):
         await acesso_negado(update)
         return
-    if not anti_spam(update.effective_user.id):
+    if not await anti_spam(update, "dar"):
         await update.message.reply_text("⏳ Ei! Espere um instante antes de usar outro comando.")
         return
     if len(context.args) < 2:
@@ -1651,9 +3132,9 @@ async def dar(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     uid_from = update.effective_user.id
-    register_username(uid_from, update.effective_user.username, update.effective_user.first_name)
+    await registrar_usuario(uid_from, update.effective_user.username, update.effective_user.first_name)
     user_tag = context.args[0]
-    target_id = username_to_id(user_tag)
+    target_id = await run_db(username_to_id, user_tag)
     nome, qtd = parse_nome_quantidade(context.args[1:])
     item_input = nome
 
@@ -1663,7 +3144,7 @@ async def dar(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if qtd < 1:
         await update.message.reply_text("❌ Quantidade inválida.")
         return
-    item_nome, item_peso, qtd_doador = buscar_item_inventario(uid_from, item_input)
+    item_nome, item_peso, qtd_doador = await run_db(buscar_item_inventario, uid_from, item_input)
     if item_nome:
         if qtd > qtd_doador:
             await update.message.reply_text(f"❌ Quantidade indisponível. Você tem {qtd_doador}x '{item_nome}'.")
@@ -1679,7 +3160,7 @@ async def dar(update: Update, context: ContextTypes.DEFAULT_TYPE):
         else:
             await update.message.reply_text(f"❌ Você não possui '{item_input}' no seu inventário.")
             return
-    target_before = get_player(target_id)
+    target_before = await run_db(get_player, target_id)
     total_depois_target = peso_total(target_before) + item_peso * qtd
     aviso_sobrecarga = ""
     if total_depois_target > target_before['peso_max']:
@@ -1687,13 +3168,12 @@ async def dar(update: Update, context: ContextTypes.DEFAULT_TYPE):
         aviso_sobrecarga = f"  ⚠️ Atenção! {target_before['nome']} ficará com sobrecarga de {excesso:.1f} kg."
     timestamp = int(time.time())
     transfer_key = f"{uid_from}_{timestamp}_{quote(item_nome)}"
-    TRANSFER_PENDING[transfer_key] = {
+    await PENDENCIAS.guardar("dar", transfer_key, {
         "item": item_nome,
         "qtd": qtd,
         "doador": uid_from,
-        "alvo": target_id,
-        "expires": timestamp + 300
-    }
+        "alvo": target_id
+    })
     keyboard = [
         [
             InlineKeyboardButton("✅ Confirmar", callback_data=f"confirm_dar_{transfer_key}"),
@@ -1716,7 +3196,7 @@ async def transfer_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     if data.startswith("confirm_dar_"):
         transfer_key = data.replace("confirm_dar_", "")
-        transfer = TRANSFER_PENDING.get(transfer_key)
+        transfer = await PENDENCIAS.get("dar", transfer_key)
         if not transfer:
             await query.edit_message_text("❌ Transferência não encontrada ou expirada.")
             return
@@ -1726,9 +3206,9 @@ async def transfer_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if user_id not in (transfer['doador'], transfer['alvo']):
             await query.answer("Só quem está envolvido pode cancelar!", show_alert=True)
             return
-        if time.time() > transfer['expires']:
-            TRANSFER_PENDING.pop(transfer_key, None)
-            await query.edit_message_text("❌ Transferência expirada.")
+        if not await PENDENCIAS.retirar("dar", transfer_key):
+            # Confirmada em outro clique (ou réplica) ou venceu agora
+            await query.edit_message_text("❌ Transferência já processada ou expirada.")
             return
 
         doador = transfer['doador']
@@ -1736,103 +3216,22 @@ async def transfer_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         item = transfer['item']
         qtd = transfer['qtd']
 
-        conn = get_conn()
-        c = conn.cursor()
         try:
-            c.execute(
-                "SELECT quantidade, peso, municao_atual, municao_max FROM inventario WHERE player_id=%s AND LOWER(nome)=LOWER(%s)",
-                (doador, item)
-            )
-            row = c.fetchone()
-
-            municao_atual, municao_max = 0, 0
-            peso_item = 0
-
-            if row:
-                qtd_doador, peso_item, municao_atual, municao_max = row
-                nova_qtd_doador = qtd_doador - qtd
-                if nova_qtd_doador <= 0:
-                    c.execute(
-                        "DELETE FROM inventario WHERE player_id=%s AND LOWER(nome)=LOWER(%s)",
-                        (doador, item)
-                    )
-                else:
-                    c.execute(
-                        "UPDATE inventario SET quantidade=%s WHERE player_id=%s AND LOWER(nome)=LOWER(%s)",
-                        (nova_qtd_doador, doador, item)
-                    )
-            else:
-                if is_admin(doador):
-                    item_info = get_catalog_item(item)
-                    if not item_info:
-                        conn.close()
-                        await query.edit_message_text("❌ Item não encontrado no catálogo.")
-                        TRANSFER_PENDING.pop(transfer_key, None)
-                        return
-                    peso_item = item_info["peso"]
-                    municao_atual = item_info.get("muni_atual", 0)
-                    municao_max = item_info.get("muni_max", 0)
-                else:
-                    conn.close()
-                    await query.edit_message_text("❌ Doador não possui o item.")
-                    TRANSFER_PENDING.pop(transfer_key, None)
-                    return
-
-            c.execute(
-                "SELECT quantidade FROM inventario WHERE player_id=%s AND LOWER(nome)=LOWER(%s)",
-                (alvo, item)
-            )
-            row_tgt = c.fetchone()
-            item_info = get_catalog_item(item)
-
-            if row_tgt:
-                nova_qtd_tgt = row_tgt[0] + qtd
-                c.execute(
-                    "UPDATE inventario SET quantidade=%s, peso=%s, consumivel=%s, bonus=%s, tipo=%s, arma_tipo=%s, arma_bonus=%s, municao_atual=%s, municao_max=%s, armas_compat=%s WHERE player_id=%s AND LOWER(nome)=LOWER(%s)",
-                    (
-                        nova_qtd_tgt, item_info["peso"],
-                        item_info.get("consumivel", False),
-                        item_info.get("bonus", '0'),
-                        item_info.get("tipo", ""),
-                        item_info.get("arma_tipo", ""),
-                        item_info.get("arma_bonus", '0'),
-                        municao_atual,
-                        municao_max,
-                        item_info.get("armas_compat", ""),
-                        alvo, item
-                    )
-                )
-            else:
-                c.execute(
-                    "INSERT INTO inventario(player_id, nome, peso, quantidade, consumivel, bonus, tipo, arma_tipo, arma_bonus, municao_atual, municao_max, armas_compat) VALUES(%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)",
-                    (
-                        alvo, item_info["nome"], item_info["peso"], qtd,
-                        item_info.get("consumivel", False),
-                        item_info.get("bonus", '0'),
-                        item_info.get("tipo", ""),
-                        item_info.get("arma_tipo", ""),
-                        item_info.get("arma_bonus", '0'),
-                        municao_atual,
-                        municao_max,
-                        item_info.get("armas_compat", "")
-                    )
-                )
-
-            conn.commit()
+            resultado = await run_db(transferir_item, doador, alvo, item, qtd)
         except Exception as e:
-            conn.rollback()
-            conn.close()
             logger.error(f"Erro na transferência: {e}")
             await query.edit_message_text("❌ Ocorreu um erro ao transferir o item.")
-            TRANSFER_PENDING.pop(transfer_key, None)
             return
-        finally:
-            conn.close()
-
-        TRANSFER_PENDING.pop(transfer_key, None)
+        if resultado == "sem_catalogo":
+            await query.edit_message_text("❌ Item não encontrado no catálogo.")
+            return
+        if resultado == "sem_item":
+            await query.edit_message_text("❌ Doador não possui o item.")
+            return
 
-        giver_after = get_player(doador)
-        target_after = get_player(alvo)
+        jogadores = await run_db(get_players, [doador, alvo])
+        giver_after = jogadores.get(doador)
+        target_after = jogadores.get(alvo)
         total_giver = peso_total(giver_after)
         total_target = peso_total(target_after)
         excesso = max(0, total_target - target_after['peso_max'])
@@ -1847,13 +3246,13 @@ async def transfer_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     elif data.startswith("cancel_dar_"):
         transfer_key = data.replace("cancel_dar_", "")
-        transfer = TRANSFER_PENDING.get(transfer_key)
+        transfer = await PENDENCIAS.get("dar", transfer_key)
         if not transfer:
             await query.edit_message_text("❌ Transferência não encontrada.")
             return
         if user_id not in (transfer['doador'], transfer['alvo']):
             return
-        TRANSFER_PENDING.pop(transfer_key, None)
+        await PENDENCIAS.retirar("dar", transfer_key)
         await query.edit_message_text("❌ Transferência cancelada.")
 
 # ========================= COMANDO ABANDONAR =========================
@@ -1861,7 +3260,7 @@ async def abandonar(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_liberado(update.effective_user.id):
         await acesso_negado(update)
         return
-    if not anti_spam(update.effective_user.id):
+    if not await anti_spam(update, "abandonar"):
         await update.message.reply_text("⏳ Ei! Espere um instante antes de usar outro comando.")
         return
     if len(context.args) < 1:
@@ -1869,7 +3268,7 @@ async def abandonar(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     uid = update.effective_user.id
     nome, qtd = parse_nome_quantidade(context.args)
-    item_nome, item_peso, qtd_inv = buscar_item_inventario(uid, nome)
+    item_nome, item_peso, qtd_inv = await run_db(buscar_item_inventario, uid, nome)
 
     if not item_nome:
         await update.message.reply_text(f"❌ Você não possui '{nome}' no seu inventário.")
@@ -1877,9 +3276,12 @@ async def abandonar(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if qtd < 1 or qtd > qtd_inv:
         await update.message.reply_text(f"❌ Quantidade inválida. Você tem {qtd_inv} '{item_nome}'.")
         return
+    # Uma chave por pedido (usuário + mensagem do comando): cada mensagem confirma o próprio item
+    abandono_key = f"{uid}_{update.message.message_id}"
+    await PENDENCIAS.guardar("abandonar", abandono_key, {"item": item_nome, "qtd": qtd})
     keyboard = [[
-        InlineKeyboardButton("✅ Confirmar", callback_data=f"confirm_abandonar_{uid}_{quote(item_nome)}_{qtd}"),
-        InlineKeyboardButton("❌ Cancelar", callback_data=f"cancel_abandonar_{uid}")
+        InlineKeyboardButton("✅ Confirmar", callback_data=f"confirm_abandonar_{abandono_key}"),
+        InlineKeyboardButton("❌ Cancelar", callback_data=f"cancel_abandonar_{abandono_key}")
     ]]
     reply_markup = InlineKeyboardMarkup(keyboard)
     await update.message.reply_text(
@@ -1893,53 +3295,34 @@ async def callback_abandonar(update: Update, context: ContextTypes.DEFAULT_TYPE)
     data = query.data
 
     if data.startswith("confirm_abandonar_"):
-        parts = data.split("_", 4)
-        if len(parts) < 5:
+        abandono_key = data.replace("confirm_abandonar_", "")
+        try:
+            uid = int(abandono_key.split("_")[0])
+        except ValueError:
             await query.edit_message_text("❌ Dados inválidos.")
             return
-        _, _, uid_str, item_nome, qtd = parts
-        uid = int(uid_str)
-        item_nome = unquote(item_nome)
-        qtd = int(qtd)
-        
+
         if query.from_user.id != uid:
             await query.answer("Só o dono pode confirmar!", show_alert=True)
             return
 
-        conn = None
+        pendente = await PENDENCIAS.retirar("abandonar", abandono_key)
+        if not pendente:
+            await query.edit_message_text("❌ Ação não encontrada ou expirada.")
+            return
+        item_nome, qtd = pendente["item"], pendente["qtd"]
+
         try:
-            conn = get_conn()
-            c = conn.cursor()
-            c.execute(
-                "SELECT quantidade FROM inventario WHERE player_id=%s AND LOWER(nome)=LOWER(%s)",
-                (uid, item_nome)
-            )
-            row = c.fetchone()
-            if not row:
-                await query.edit_message_text("❌ Item não encontrado no inventário.")
-                return
-            qtd_inv = row[0]
-            if qtd >= qtd_inv:
-                c.execute(
-                    "DELETE FROM inventario WHERE player_id=%s AND LOWER(nome)=LOWER(%s)",
-                    (uid, item_nome)
-                )
-            else:
-                c.execute(
-                    "UPDATE inventario SET quantidade=%s WHERE player_id=%s AND LOWER(nome)=LOWER(%s)",
-                    (qtd_inv - qtd, uid, item_nome)
-                )
-            conn.commit()
+            encontrado = await run_db(abandonar_item, uid, item_nome, qtd)
         except Exception as e:
-            conn.rollback()
             logger.error(f"Erro ao abandonar item: {e}")
             await query.edit_message_text("❌ Erro ao abandonar o item.")
             return
-        finally:
-            if conn:
-                put_conn(conn)
+        if not encontrado:
+            await query.edit_message_text("❌ Item não encontrado no inventário.")
+            return
 
-        jogador = get_player(uid)
+        jogador = await run_db(get_player, uid)
         total_peso = peso_total(jogador)
 
         await query.edit_message_text(
@@ -1948,8 +3331,9 @@ async def callback_abandonar(update: Update, context: ContextTypes.DEFAULT_TYPE)
         )
 
     elif data.startswith("cancel_abandonar_"):
+        abandono_key = data.replace("cancel_abandonar_", "")
         try:
-            uid = int(data.split("_")[-1])
+            uid = int(abandono_key.split("_")[0])
         except ValueError:
             await query.edit_message_text("❌ Dados inválidos.")
             return
@@ -1958,6 +3342,7 @@ async def callback_abandonar(update: Update, context: ContextTypes.DEFAULT_TYPE)
             await query.answer("Só o dono pode cancelar!", show_alert=True)
             return
 
+        await PENDENCIAS.retirar("abandonar", abandono_key)
         await query.answer()
         await query.edit_message_text("❌ Ação cancelada.")
 
@@ -1968,7 +3353,7 @@ async def recarregar(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_liberado(update.effective_user.id):
         await acesso_negado(update)
         return
-    if not anti_spam(update.effective_user.id):
+    if not await anti_spam(update, "recarregar"):
         await update.message.reply_text("⏳ Ei! Espere um instante antes de usar outro comando.")
         return
     if len(context.args) < 1:
@@ -1985,12 +3370,12 @@ async def recarregar(update: Update, context: ContextTypes.DEFAULT_TYPE):
     qtd_str = m.group(3) or m.group(4)
     qtd = int(qtd_str) if qtd_str else 1
 
-    item_nome, _, qtd_inv = buscar_item_inventario(uid, item_municao)
+    item_nome, _, qtd_inv = await run_db(buscar_item_inventario, uid, item_municao)
     if not item_nome or qtd_inv < 1:
         await update.message.reply_text(f"❌ Você não possui '{item_municao}' no seu inventário.")
         return
 
-    arma_nome, _, arma_qtd = buscar_item_inventario(uid, item_arma)
+    arma_nome, _, arma_qtd = await run_db(buscar_item_inventario, uid, item_arma)
     if not arma_nome or arma_qtd < 1:
         await update.message.reply_text(f"❌ Você não possui '{item_arma}' no seu inventário.")
         return
@@ -2009,7 +3394,7 @@ async def recarregar(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ Essa munição não é compatível com essa arma.")
         return
 
-    player = get_player(uid)
+    player = await run_db(get_player, uid)
     arma_obj = None
     for i in player["inventario"]:
         if normalizar(i["nome"]) == normalizar(arma_nome):
@@ -2029,13 +3414,14 @@ async def recarregar(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ Não é possível recarregar essa quantidade (verifique munição e espaço).")
         return
 
-    global LAST_RELOAD
-    LAST_RELOAD[uid] = (item_nome, arma_nome, recarregar_max)
+    # Chave por pedido, como no /abandonar: dois /recarregar seguidos não se sobrescrevem
+    recarga_key = f"{uid}_{update.message.message_id}"
+    await PENDENCIAS.guardar("recarga", recarga_key, [item_nome, arma_nome, recarregar_max])
 
     keyboard = [
         [
-            InlineKeyboardButton("✅ Confirmar", callback_data=f"confirm_recarregar_{uid}"),
-            InlineKeyboardButton("❌ Cancelar", callback_data=f"cancel_recarregar_{uid}")
+            InlineKeyboardButton("✅ Confirmar", callback_data=f"confirm_recarregar_{recarga_key}"),
+            InlineKeyboardButton("❌ Cancelar", callback_data=f"cancel_recarregar_{recarga_key}")
         ]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
@@ -2051,48 +3437,36 @@ async def recarregar(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def callback_recarregar(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     data = query.data
-    uid = query.from_user.id
-
-    global LAST_RELOAD
+    acao, _, recarga_key = data.partition("_recarregar_")
+    try:
+        uid = int(recarga_key.split("_")[0])
+    except ValueError:
+        await query.edit_message_text("❌ Dados inválidos.")
+        return
+    if query.from_user.id != uid:
+        await query.answer("Só o dono pode confirmar!", show_alert=True)
+        return
 
-    if data == f"confirm_recarregar_{uid}":
-        reload_data = LAST_RELOAD.get(uid)
+    if acao == "confirm":
+        reload_data = await PENDENCIAS.retirar("recarga", recarga_key)
         if not reload_data or len(reload_data) != 3:
             await query.edit_message_text("❌ Dados de recarga não encontrados.")
             return
         municao, arma, qtd = reload_data
 
-        conn = get_conn()
-        c = conn.cursor()
-        c.execute("SELECT quantidade FROM inventario WHERE player_id=%s AND LOWER(nome)=LOWER(%s)", (uid, municao))
-        row = c.fetchone()
-        if not row or row[0] < qtd:
-            conn.close()
+        resultado = await run_db(recarregar_arma, uid, municao, arma, qtd)
+        if resultado == "sem_municao":
             await query.edit_message_text("❌ Munição insuficiente.")
             return
-        nova = row[0] - qtd
-        if nova <= 0:
-            c.execute("DELETE FROM inventario WHERE player_id=%s AND LOWER(nome)=LOWER(%s)", (uid, municao))
-        else:
-            c.execute("UPDATE inventario SET quantidade=%s WHERE player_id=%s AND LOWER(nome)=LOWER(%s)", (nova, uid, municao))
-
-        c.execute("SELECT municao_atual, municao_max FROM inventario WHERE player_id=%s AND LOWER(nome)=LOWER(%s)", (uid, arma))
-        row = c.fetchone()
-        if not row:
-            conn.close()
+        if resultado == "sem_arma":
             await query.edit_message_text("❌ Arma não encontrada no inventário.")
             return
-        mun_atual, mun_max = row
-        novo_mun = min(mun_max, mun_atual + qtd)
-        c.execute("UPDATE inventario SET municao_atual=%s WHERE player_id=%s AND LOWER(nome)=LOWER(%s)", (novo_mun, uid, arma))
-        conn.commit()
-        conn.close()
+        mun_atual, novo_mun, mun_max = resultado
         await query.edit_message_text(f"🔫 <b>{arma}</b> recarregada! [{mun_atual} → {novo_mun}/{mun_max}] balas.", parse_mode="HTML")
-        LAST_RELOAD.pop(uid, None)
         return
 
-    elif data == f"cancel_recarregar_{uid}":
-        LAST_RELOAD.pop(uid, None)
+    elif acao == "cancel":
+        await PENDENCIAS.retirar("recarga", recarga_key)
         await query.edit_message_text("❌ Recarga cancelada.")
         return
 
@@ -2100,7 +3474,7 @@ async def consumir(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_liberado(update.effective_user.id):
         await acesso_negado(update)
         return
-    if not anti_spam(update.effective_user.id):
+    if not await anti_spam(update, "consumir"):
         await update.message.reply_text("⏳ Ei! Espere um instante antes de usar outro comando.")
         return
     if len(context.args) < 1:
@@ -2108,7 +3482,7 @@ async def consumir(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     uid = update.effective_user.id
     nome, qtd = parse_nome_quantidade(context.args)
-    item_nome, item_peso, qtd_inv = buscar_item_inventario(uid, nome)
+    item_nome, item_peso, qtd_inv = await run_db(buscar_item_inventario, uid, nome)
     if not item_nome:
         await update.message.reply_text("❌ Você não possui esse item.")
         return
@@ -2119,6 +3493,10 @@ async def consumir(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not cat_item or not cat_item.get("consumivel"):
         await update.message.reply_text(f"❌ '{item_nome}' não é um item consumível.")
         return
+    # Debita antes de aplicar o efeito: dois /consumir simultâneos não gastam o mesmo item
+    if not await run_db(adjust_item_quantity, uid, item_nome, -qtd, qtd):
+        await update.message.reply_text(f"❌ Item insuficiente: '{item_nome}'.")
+        return
     efeito = cat_item.get("tipo")
     bonus = cat_item.get("bonus", '0')
     msg = f"🍴 Você consumiu '{item_nome}' x{qtd}."
@@ -2131,31 +3509,28 @@ async def consumir(update: Update, context: ContextTypes.DEFAULT_TYPE):
         msg += "\n⚠️ Use /recarregar para aplicar essa munição."
     if efeito == "comida":
         rest = cat_item.get("rest_hunger", 0) * qtd
-        update_necessidades(uid, fome_delta=-rest)
-        registrar_consumo(uid, "comida")
-        await checar_alerta_necessidades(uid, context.bot)
+        necessidades = await run_db(update_necessidades, uid, fome_delta=-rest, consumo="comida")
+        await checar_alerta_necessidades(uid, context.bot, necessidades)
         msg += f"\n🍽️ Fome reduzida em {rest}."
     elif efeito == "bebida":
         rest = cat_item.get("rest_thirst", 0) * qtd
-        update_necessidades(uid, sede_delta=-rest)
-        registrar_consumo(uid, "bebida")
-        await checar_alerta_necessidades(uid, context.bot)
+        necessidades = await run_db(update_necessidades, uid, sede_delta=-rest, consumo="bebida")
+        await checar_alerta_necessidades(uid, context.bot, necessidades)
         msg += f"\n💧 Sede reduzida em {rest}."
     elif efeito == "nenhum":
         msg += "\n(Nenhum efeito direto, apenas roleplay)."
         
-    adjust_item_quantity(uid, item_nome, -qtd)
     await update.message.reply_text(msg)
 
 async def dano(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_liberado(update.effective_user.id):
         await acesso_negado(update)
         return
-    if not anti_spam(update.effective_user.id):
+    if not await anti_spam(update, "dano"):
         await update.message.reply_text("⏳ Ei! Espere um instante antes de usar outro comando.")
         return
     uid = update.effective_user.id
-    register_username(uid, update.effective_user.username, update.effective_user.first_name)
+    await registrar_usuario(uid, update.effective_user.username, update.effective_user.first_name)
     if len(context.args) < 1:
         await update.message.reply_text("Uso: /dano hp|sp [@jogador] [pericia/arma/consumivel]")
         return
@@ -2176,15 +3551,18 @@ async def dano(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     if args and args[0].startswith('@'):
         alvo_tag = args[0]
-        t = username_to_id(alvo_tag)
+        t = await run_db(username_to_id, alvo_tag)
         if t:
             alvo_id = t
             responder_em_si = False
         args = args[1:]
+
+    jogadores = await run_db(get_players, [uid, alvo_id])
+    atacante = jogadores.get(uid)
         
     if args:
         extra = " ".join(args)
-        item_nome, _, qtd_inv = buscar_item_inventario(uid, extra)
+        item_nome, _, qtd_inv = await run_db(buscar_item_inventario, uid, extra)
         item_obj = get_catalog_item(item_nome) if item_nome else None
         
         if item_obj:
@@ -2198,28 +3576,24 @@ async def dano(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 
                 if item_obj['arma_tipo'] == 'melee':
                     pericia_usada = 'Luta'
-                    bonus_pericia = get_player(uid)['pericias'].get('Luta', 0)
+                    bonus_pericia = atacante['pericias'].get('Luta', 0)
                 elif item_obj['arma_tipo'] == 'range':
-                    conn = get_conn()
-                    c = conn.cursor()
-                    c.execute("SELECT municao_atual FROM inventario WHERE player_id=%s AND LOWER(nome)=LOWER(%s)", (uid, item_obj['nome']))
-                    row = c.fetchone()
-                    conn.close()
-                    if not row or row[0] is None or row[0] <= 0:
+                    if not await run_db(gastar_municao, uid, item_obj['nome']):
                         await update.message.reply_text(f"❌ Você está sem munição na arma '{item_obj['nome']}'!")
                         return
-                    update_weapon_ammo(uid, item_obj['nome'], row[0] - 1)
                     pericia_usada = 'Pontaria'
-                    bonus_pericia = get_player(uid)['pericias'].get('Pontaria', 0)
+                    bonus_pericia = atacante['pericias'].get('Pontaria', 0)
                     
             elif item_obj['consumivel'] and item_obj['tipo'] == "dano":
                 consumable_bonus_notation = item_obj['bonus']
                 dice_params = parse_dice_notation(consumable_bonus_notation)
                 if dice_params:
+                    if not await run_db(adjust_item_quantity, uid, item_nome, -1, 1):  # Consome o item
+                        await update.message.reply_text(f"❌ Item insuficiente: '{item_nome}'.")
+                        return
                     bonus_consumivel_roll = roll_dados(dice_params[0], dice_params[1])
                     bonus_consumivel = sum(bonus_consumivel_roll)
                     bonus_consumivel_str = f" ({consumable_bonus_notation}): {bonus_consumivel_roll} -> {bonus_consumivel}"
-                    adjust_item_quantity(uid, item_nome, -1) # Consome o item
                 else:
                     await update.message.reply_text("❌ Consumível de dano com formato de bônus inválido.")
                     return
@@ -2230,7 +3604,7 @@ async def dano(update: Update, context: ContextTypes.DEFAULT_TYPE):
             extra_norm = normalizar(extra)
             if extra_norm in ["forca", "luta", "pontaria"]:
                 pericia_usada = ATRIBUTOS_NORMAL.get(extra_norm) or PERICIAS_NORMAL.get(extra_norm)
-                bonus_pericia = get_player(uid)['atributos'].get(pericia_usada, 0) if extra_norm == "forca" else get_player(uid)['pericias'].get(pericia_usada, 0)
+                bonus_pericia = atacante['atributos'].get(pericia_usada, 0) if extra_norm == "forca" else atacante['pericias'].get(pericia_usada, 0)
                 
     if responder_em_si:
         texto_acao = f"{mention(update.effective_user)} causou dano em si."
@@ -2249,18 +3623,14 @@ async def dano(update: Update, context: ContextTypes.DEFAULT_TYPE):
         msg += f"Bônus de consumível{bonus_consumivel_str}\n"
     msg += f"Total: {total}\n"
     
-    alvo_player = get_player(alvo_id)
+    alvo_player = jogadores.get(alvo_id)
     if tipo in ("hp", "vida"):
-        before = alvo_player['hp']
-        after = max(0, before - total)
-        update_player_field(alvo_id, 'hp', after)
+        before, after = (await run_db(alterar_vitais, alvo_id, hp=-total))["hp"]
         msg += f"{alvo_player['nome']}: HP {before} → {after}"
         if after == 0:
             msg += "\n💀 Entrou em coma! Use /inconsciente."
     else:
-        before = alvo_player['sp']
-        after = max(0, before - total)
-        update_player_field(alvo_id, 'sp', after)
+        before, after = (await run_db(alterar_vitais, alvo_id, sp=-total))["sp"]
         msg += f"{alvo_player['nome']}: SP {before} → {after}"
         if after == 0:
             trauma = random.choice(TRAUMAS)
@@ -2272,11 +3642,11 @@ async def cura(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_liberado(update.effective_user.id):
         await acesso_negado(update)
         return
-    if not anti_spam(update.effective_user.id):
+    if not await anti_spam(update, "cura"):
         await update.message.reply_text("⏳ Ei! Espere um instante antes de usar outro comando.")
         return
     uid = update.effective_user.id
-    register_username(uid, update.effective_user.username, update.effective_user.first_name)
+    await registrar_usuario(uid, update.effective_user.username, update.effective_user.first_name)
     if len(context.args) < 1:
         await update.message.reply_text("Uso: /cura [@jogador] NomeDoKitOuConsumivel")
         return
@@ -2286,7 +3656,7 @@ async def cura(update: Update, context: ContextTypes.DEFAULT_TYPE):
     responder_em_si = True
     if args[0].startswith('@'):
         alvo_tag = args[0]
-        t = username_to_id(alvo_tag)
+        t = await run_db(username_to_id, alvo_tag)
         if t:
             alvo_id = t
             responder_em_si = False
@@ -2295,13 +3665,14 @@ async def cura(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ Falta nome do kit ou consumível.")
         return
     kit_input = " ".join(args).strip()
-    kit_nome, _, qtd_inv = buscar_item_inventario(uid, kit_input)
+    kit_nome, _, qtd_inv = await run_db(buscar_item_inventario, uid, kit_input)
     if not kit_nome or qtd_inv < 1:
         await update.message.reply_text(f"❌ Você não possui '{kit_input}' no inventário.")
         return
     kit_obj = get_catalog_item(kit_nome)
     bonus_kit = 0
-    bonus_med = get_player(uid)['pericias'].get('Medicina', 0)
+    jogadores = await run_db(get_players, [uid, alvo_id])
+    bonus_med = jogadores[uid]['pericias'].get('Medicina', 0)
     
     if kit_obj:
         if kit_obj['consumivel'] and kit_obj['tipo'] == "cura":
@@ -2320,14 +3691,14 @@ async def cura(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("❌ Kit inválido. Use: Kit Básico, Intermediário, Avançado ou um item de cura válido.")
             return
 
-    adjust_item_quantity(uid, kit_nome, -1)
+    if not await run_db(adjust_item_quantity, uid, kit_nome, -1, 1):
+        await update.message.reply_text(f"❌ Item insuficiente: '{kit_nome}'.")
+        return
 
     dado = random.randint(1, 6)
     total = dado + bonus_kit + bonus_med
-    alvo = get_player(alvo_id)
-    before = alvo['hp']
-    after = min(alvo['hp_max'], before + total)
-    update_player_field(alvo_id, 'hp', after)
+    alvo = jogadores.get(alvo_id)
+    before, after = (await run_db(alterar_vitais, alvo_id, hp=total))["hp"]
     
     if responder_em_si:
         texto_acao = f"{mention(update.effective_user)} aplicou cura em si mesmo"
@@ -2349,22 +3720,20 @@ async def status(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_liberado(update.effective_user.id):
         await acesso_negado(update)
         return
-    if not anti_spam(update.effective_user.id):
+    if not await anti_spam(update, "status"):
         await update.message.reply_text("⏳ Ei! Espere um instante antes de usar outro comando.")
         return
     uid = update.effective_user.id
 
     if context.args and is_admin(uid):
         user_tag = context.args[0]
-        target_id = username_to_id(user_tag)
+        target_id = await run_db(username_to_id, user_tag)
         if not target_id:
             await update.message.reply_text("❌ Jogador não encontrado.")
             return
-        atualizar_necessidades_por_tempo(target_id)
-        player = get_player(target_id)
+        player = await run_db(get_player, target_id)
     else:
-        atualizar_necessidades_por_tempo(uid)
-        player = get_player(uid)
+        player = await run_db(get_player, uid)
 
     if not player:
         await update.message.reply_text("Use /start primeiro!")
@@ -2381,7 +3750,7 @@ async def status(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text += f"🧠 Sanidade: {sp}/{sp_max}\n\n"
     resistencia = player["pericias"].get("Resistência", 1)
     max_horas = resistencia_horas_max(resistencia)
-    horas_sem_comer, horas_sem_beber, horas_sem_dormir = get_horas_sem_recursos(player["id"])
+    horas_sem_comer, horas_sem_beber, horas_sem_dormir = get_horas_sem_recursos(player)
     text += f"🍽️ Fome: {faixa_status(fome, 'fome')}"
     if horas_sem_comer is not None:
         text += f" | {horas_sem_comer:.1f}h sem comer (máx {max_horas}h)\n"
@@ -2409,16 +3778,16 @@ async def terapia(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_liberado(update.effective_user.id):
         await acesso_negado(update)
         return
-    if not anti_spam(update.effective_user.id):
+    if not await anti_spam(update, "terapia"):
         await update.message.reply_text("⏳ Ei! Espere um instante antes de usar outro comando.")
         return
     uid = update.effective_user.id
-    register_username(uid, update.effective_user.username, update.effective_user.first_name)
+    await registrar_usuario(uid, update.effective_user.username, update.effective_user.first_name)
     if len(context.args) < 1:
         await update.message.reply_text("Uso: /terapia @jogador")
         return
     alvo_tag = context.args[0]
-    alvo_id = username_to_id(alvo_tag)
+    alvo_id = await run_db(username_to_id, alvo_tag)
     if not alvo_id:
         await update.message.reply_text("❌ Jogador não encontrado. Peça para a pessoa usar /start.")
         return
@@ -2426,15 +3795,14 @@ async def terapia(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ Terapia só pode ser aplicada em outra pessoa.")
         return
 
-    healer = get_player(uid)
+    jogadores = await run_db(get_players, [uid, alvo_id])
+    healer = jogadores.get(uid)
     bonus_pers = healer['pericias'].get('Manipulação', 0)
     dado = random.randint(1, 6)
     total = dado + bonus_pers
 
-    alvo = get_player(alvo_id)
-    before = alvo['sp']
-    after = min(alvo['sp_max'], before + total)
-    update_player_field(alvo_id, 'sp', after)
+    alvo = jogadores.get(alvo_id)
+    before, after = (await run_db(alterar_vitais, alvo_id, sp=total))["sp"]
 
     msg = (
         f"🎲 {mention(update.effective_user)} aplicou uma sessão de terapia em {alvo_tag}!\n"
@@ -2449,13 +3817,13 @@ async def inconsciente(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_liberado(update.effective_user.id):
         await acesso_negado(update)
         return
-    if not anti_spam(update.effective_user.id):
+    if not await anti_spam(update, "inconsciente"):
         await update.message.reply_text("⏳ Ei! Espere um instante antes de usar outro comando.")
         return
 
     uid = update.effective_user.id
-    register_username(uid, update.effective_user.username, update.effective_user.first_name)
-    player = get_player(uid)
+    await registrar_usuario(uid, update.effective_user.username, update.effective_user.first_name)
+    player = await run_db(get_player, uid)
     if not player:
         await update.message.reply_text("Use /start primeiro!")
         return
@@ -2463,13 +3831,13 @@ async def inconsciente(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ Você não está inconsciente (HP > 0).")
         return
 
-    if not registrar_teste_coma(uid):
+    if not await run_db(registrar_teste_coma, uid):
         await update.message.reply_text("⚠️ Você já fez um teste de inconsciente hoje. Só é permitido 1 por dia.")
         return
 
     resistencia = player['pericias'].get('Resistência', 0)
     dado = random.randint(1, 20)
-    bonus_ajuda = pop_coma_bonus(uid)
+    bonus_ajuda = await run_db(pop_coma_bonus, uid)
     total = dado + resistencia + bonus_ajuda
 
     if total <= 5:
@@ -2477,12 +3845,12 @@ async def inconsciente(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif total <= 12:
         status = "💀 Continua inconsciente. O corpo permanece desacordado, lutando por cada respiração."
     elif total <= 19:
-        update_player_field(uid, 'hp', 1)
+        await run_db(update_player_field, uid, 'hp', 1)
         status = "🌅 Você desperta, fraco e atordoado. HP agora: 1."
     else:
         extra_hp = random.randint(2, 5)
         new_hp = min(player['hp_max'], extra_hp)
-        update_player_field(uid, 'hp', new_hp)
+        await run_db(update_player_field, uid, 'hp', new_hp)
         status = f"🌟 Sucesso crítico! Um milagre: você acorda com {new_hp} HP, mais forte que antes!"
 
     await update.message.reply_text(
@@ -2500,13 +3868,13 @@ async def roll(update: Update, context: ContextTypes.DEFAULT_TYPE, consumir_rero
     if not is_liberado(update.effective_user.id):
         await acesso_negado(update)
         return
-    if not anti_spam(update.effective_user.id) and not consumir_reroll:
+    if not consumir_reroll and not await anti_spam(update, "roll"):
         await update.message.reply_text("⏳ Espere um instante antes de usar outro comando.")
         return False
 
     uid = update.effective_user.id
-    register_username(uid, update.effective_user.username, update.effective_user.first_name)
-    player = get_player(uid)
+    await registrar_usuario(uid, update.effective_user.username, update.effective_user.first_name)
+    player = await run_db(get_player, uid)
     if not player or len(context.args) < 1:
         await update.message.reply_text("Uso: /roll nome_da_pericia_ou_atributo OU /roll d20+2")
         return False
@@ -2567,7 +3935,7 @@ async def reroll(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await acesso_negado(update)
         return
     uid = update.effective_user.id
-    player = get_player(uid)
+    player = await run_db(get_player, uid)
     if not player:
         await update.message.reply_text("Use /start primeiro!")
         return
@@ -2580,33 +3948,31 @@ async def reroll(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Uso: /reroll nome_da_pericia_ou_atributo")
         return
 
-    ok = await roll(update, context, consumir_reroll=True)
+    # Gasta antes de rolar: dois /reroll simultâneos não rolam com o mesmo reroll
+    novos_rerolls = await run_db(gastar_reroll, uid)
+    if novos_rerolls is None:
+        await update.message.reply_text("❌ Você não tem rerolls disponíveis hoje!")
+        return
 
-    if ok:
-        novos_rerolls = player['rerolls'] - 1
-        update_player_field(uid, 'rerolls', novos_rerolls)
+    ok = await roll(update, context, consumir_reroll=True)
+    if not ok:
+        await run_db(devolver_reroll, uid)
+        return
 
-        await update.message.reply_text(
-            f"🔄 Reroll usado! Rerolls restantes: {novos_rerolls}"
-        )
+    await update.message.reply_text(
+        f"🔄 Reroll usado! Rerolls restantes: {novos_rerolls}"
+    )
 
 async def xp(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_liberado(update.effective_user.id):
         await acesso_negado(update)
         return
-    if not anti_spam(update.effective_user.id):
+    if not await anti_spam(update, "xp"):
         await update.message.reply_text("⏳ Ei! Espere um instante antes de usar outro comando.")
         return
     uid = update.effective_user.id
     semana = semana_atual()
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute("SELECT xp_total, streak_atual FROM xp_semana WHERE player_id=%s AND semana_inicio=%s", (uid, semana))
-    row = c.fetchone()
-    xp_total = row[0] if row else 0
-    streak = row[1] if row else 0
-    c.execute("SELECT data, caracteres, mencoes FROM turnos WHERE player_id=%s AND data >= %s ORDER BY data", (uid, semana))
-    dias = c.fetchall()
+    xp_total, streak, dias = await run_db(get_xp_semana, uid, semana)
     lines = [f"📊 <b>Seu XP semanal:</b> {xp_total} XP", f"Streak atual: {streak} dias"]
     for d in dias:
         data, chars, menc = d
@@ -2628,39 +3994,20 @@ async def ranking(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_liberado(update.effective_user.id):
         await acesso_negado(update)
         return
-    if not anti_spam(update.effective_user.id):
-        await update.message.reply_text("⏳ Ei! Espere um instante antes de usar outro comando.")
+    if not await anti_spam(update, "ranking"):
+        await update.effective_message.reply_text("⏳ Ei! Espere um instante antes de usar outro comando.")
         return
     semana = semana_atual()
-    conn = get_conn()
-    c = conn.cursor()
-
-    c.execute("""
-        SELECT player_id, xp_total, streak_atual
-        FROM xp_semana
-        WHERE semana_inicio=%s
-        ORDER BY xp_total DESC
-        LIMIT 10
-    """, (semana,))
-    top = c.fetchall()
-
-    c.execute("""
-        SELECT player_id, xp_total, streak_atual
-        FROM xp_semana
-        WHERE semana_inicio=%s
-        ORDER BY xp_total DESC
-    """, (semana,))
-    ranking_full = c.fetchall()
-    conn.close()
-
-    players = {pid: get_player(pid) for pid, _, _ in ranking_full}
-
     uid = update.effective_user.id
+    if PLACAR.atual(semana):
+        top, voce = PLACAR.consultar(uid)
+    else:
+        top, voce = await run_db(get_ranking, semana, uid)
+
     lines = ["🏆 <b>Ranking semanal (Top 10)</b>"]
     medals = ['🥇', '🥈', '🥉']
 
-    for idx, (pid, xp, streak) in enumerate(top):
-        nome = players[pid]['nome'] if players.get(pid) else f"ID:{pid}"
+    for idx, (pid, nome, xp, streak, _) in enumerate(top):
         medal = medals[idx] if idx < len(medals) else f"{idx+1}."
         highlight = " <b>(Você)</b>" if pid == uid else ""
         lines.append(f"{medal} <b>{nome}</b> — {xp} XP | 🔥 Streak: {streak}d{highlight}")
@@ -2668,14 +4015,11 @@ async def ranking(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not top:
         lines.append("Ninguém tem XP ainda nesta semana!")
 
-    if uid not in [pid for pid, _, _ in top]:
-        for pos, (pid, xp, streak) in enumerate(ranking_full, start=1):
-            if pid == uid:
-                nome = players[pid]['nome'] if players.get(pid) else f"ID:{pid}"
-                lines.append(
-                    f"\n➡️ Sua posição: {pos}º — <b>{nome}</b> — {xp} XP | 🔥 Streak: {streak}d"
-                )
-                break
+    if voce:
+        _, nome, xp, streak, pos = voce
+        lines.append(
+            f"\n➡️ Sua posição: {pos}º — <b>{nome}</b> — {xp} XP | 🔥 Streak: {streak}d"
+        )
 
     text = "\n".join(lines)
 
@@ -2688,7 +4032,7 @@ async def dormir(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_liberado(update.effective_user.id):
         await acesso_negado(update)
         return
-    if not anti_spam(update.effective_user.id):
+    if not await anti_spam(update, "dormir"):
         await update.message.reply_text("⏳ Espere um instante antes de usar outro comando.")
         return
     if len(context.args) < 1:
@@ -2704,7 +4048,7 @@ async def dormir(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     uid = update.effective_user.id
-    player = get_player(uid)
+    player = await run_db(get_player, uid)
     if not player:
         await update.message.reply_text("Use /start primeiro!")
         return
@@ -2712,12 +4056,9 @@ async def dormir(update: Update, context: ContextTypes.DEFAULT_TYPE):
     multiplicador = 12
     sono_antes = player.get("sono", 0)
     sono_recuperado = min(sono_antes, horas * multiplicador)
-    sono_novo = max(0, sono_antes - sono_recuperado)
 
     hp_max = player.get("hp_max", 40)
     sp_max = player.get("sp_max", 40)
-    hp_antes = player.get("hp", 0)
-    sp_antes = player.get("sp", 0)
 
     sono_total = max(sono_antes, 1)
     proporcao = sono_recuperado / sono_total if sono_antes > 0 else 0
@@ -2725,13 +4066,11 @@ async def dormir(update: Update, context: ContextTypes.DEFAULT_TYPE):
     rec_hp = int(hp_max * 0.2 * proporcao)
     rec_sp = int(sp_max * 0.2 * proporcao)
 
-    hp_novo = min(hp_max, hp_antes + rec_hp)
-    sp_novo = min(sp_max, sp_antes + rec_sp)
-
-    update_necessidades(uid, sono_delta=-sono_recuperado, fome_delta=+horas*2, sede_delta=+horas*1)
-    registrar_consumo(uid, "sono")
-    update_player_field(uid, "hp", hp_novo)
-    update_player_field(uid, "sp", sp_novo)
+    necessidades = await run_db(update_necessidades, uid, sono_delta=-sono_recuperado, fome_delta=+horas*2, sede_delta=+horas*1, consumo="sono")
+    vitais = await run_db(alterar_vitais, uid, hp=rec_hp, sp=rec_sp)
+    hp_antes, hp_novo = vitais["hp"]
+    sp_antes, sp_novo = vitais["sp"]
+    sono_novo = necessidades["sono"]
 
     msg = (
         f"💤 Você dormiu {horas}h."
@@ -2742,18 +4081,18 @@ async def dormir(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"\n💧 Sede aumentou em {horas*1}."
     )
     await update.message.reply_text(msg)
-    await checar_alerta_necessidades(uid, context.bot)
+    await checar_alerta_necessidades(uid, context.bot, necessidades)
 
-async def checar_alerta_necessidades(uid, bot):
-    player = get_player(uid)
-    if not player:
+async def checar_alerta_necessidades(uid, bot, necessidades):
+    """necessidades: o retorno de update_necessidades."""
+    if not necessidades:
         return
     alertas = []
-    if player.get("fome", 0) >= 90:
+    if necessidades.get("fome", 0) >= 90:
         alertas.append("⚠️ Sua fome está em estado crítico! Consuma comida o quanto antes.")
-    if player.get("sede", 0) >= 90:
+    if necessidades.get("sede", 0) >= 90:
         alertas.append("⚠️ Sua sede está em estado crítico! Beba algo o quanto antes.")
-    if player.get("sono", 0) >= 90:
+    if necessidades.get("sono", 0) >= 90:
         alertas.append("⚠️ Seu sono está em estado crítico! Você precisa dormir urgentemente.")
     if alertas:
         try:
@@ -2773,11 +4112,11 @@ def run_flask():
 
 # ========== MAIN ==========
 def main():
-    global POOL
+    global POOL, DB_EXECUTOR
     try:
         POOL = psycopg2.pool.ThreadedConnectionPool(
-            minconn=1,
-            maxconn=10,
+            minconn=min(DB_POOL_MIN, DB_POOL_MAX),
+            maxconn=DB_POOL_MAX,
             dsn=DATABASE_URL,
             cursor_factory=psycopg2.extras.DictCursor
         )
@@ -2786,16 +4125,27 @@ def main():
         logger.error(f"❌ Falha ao iniciar o pool de conexões: {e}")
         return
 
+    DB_EXECUTOR = ThreadPoolExecutor(max_workers=DB_WORKERS, thread_name_prefix="db")
+
     init_db()
+    CATALOGO.carregar()
+    LIBERADOS.carregar()
+    PLACAR.carregar(semana_atual())
+    PENDENCIAS.carregar()
     threading.Thread(target=run_flask, daemon=True).start()
-    threading.Thread(target=reset_diario_rerolls, daemon=True).start()
-    threading.Thread(target=cleanup_expired_transfers, daemon=True).start()
-    threading.Thread(target=thread_reset_xp, daemon=True).start()
-    threading.Thread(target=reset_coma_teste, daemon=True).start()
-    app = Application.builder().token(TOKEN).build()
+    app = (
+        Application.builder()
+        .token(TOKEN)
+        .post_init(ao_iniciar)
+        .post_shutdown(ao_encerrar)
+        .concurrent_updates(CONCURRENT_UPDATES)
+        .build()
+    )
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("ficha", ficha))
     app.add_handler(CommandHandler("verficha", verficha))
+    app.add_handler(CommandHandler("metricas", metricas))
+    app.add_handler(CommandHandler("agenda", agenda))
     app.add_handler(CommandHandler("inventario", inventario))
     app.add_handler(CommandHandler("itens", itens))
     app.add_handler(CommandHandler("additem", additem))
@@ -2825,7 +4175,13 @@ def main():
     app.add_handler(CommandHandler("status", status))
     app.add_handler(CommandHandler("dormir", dormir))
     app.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND), texto_handler))
-    app.run_polling()
+    try:
+        app.run_polling()
+    finally:
+        try:
+            flush_last_seen()
+        except Exception as e:
+            logger.error(f"Erro ao gravar last_seen no desligamento: {e}")
 
 if __name__ == "__main__":
     main()